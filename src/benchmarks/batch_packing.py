@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------------
+# File: batch_packing.py
+# Description: compares the legacy word-count batching (ctx_len // 4 words)
+#              with token-accurate packing, reporting the number of LLM calls
+#              (batches) per corpus and how many batches overflow the budget.
+#
+# Usage (from src/): python -m benchmarks.batch_packing --ip localhost --port 8502
+#                    without --ip, tokens are approximated from word counts.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import argparse
+import glob
+import os
+from collections import defaultdict
+from typing import Dict, List
+
+import dotenv
+import nltk
+
+from llm import get_llm_client, memory_wrapper, question_and_reason_prompt
+from utils.batch import TokenCounter, get_sentence_batches, get_token_budget
+
+dotenv.load_dotenv()
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+corpora = {
+    "3-examples": os.path.join(DATA_FOLDER, "3-examples", "*.txt"),
+    "20-examples": os.path.join(DATA_FOLDER, "20-examples", "*.txt"),
+    "open-case": os.path.join(DATA_FOLDER, "open-case.txt"),
+}
+
+
+def load_corpus(pattern: str, lang: str) -> Dict[str, List[str]]:
+    documents = {}
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            sentences = []
+            for line in f:
+                if line.strip():
+                    sentences.extend(nltk.sent_tokenize(line.strip(), language=lang))
+        documents[os.path.basename(path)] = sentences
+    return documents
+
+
+def legacy_sentence_batches(texts: List[str], TOKEN_LEN: int) -> Dict[int, List[str]]:
+    # the original packer: words as tokens, reset after crossing the limit
+    token_batches = defaultdict(list)
+    current_token_count = 0
+    current_batch = 0
+    for sentence in texts:
+        current_token_count += len(sentence.split())
+        if current_token_count > TOKEN_LEN:
+            current_token_count = 0
+            current_batch += 1
+        token_batches[current_batch].append(sentence)
+    return token_batches
+
+
+def run(
+    ip_address: str = None,
+    port: int = 8502,
+    llm_ctx_len: int = 8168,
+    new_tokens: int = 4096,
+    memory_tokens: int = 1000,
+    lang: str = "norwegian",
+):
+    tokenize = get_llm_client(ip_address, port).tokenize if ip_address else None
+    count_tokens = TokenCounter(tokenize)
+    query = "find the mentioned laws referenced in the case, along with all monetary settlements"
+
+    for name, pattern in corpora.items():
+        documents = load_corpus(pattern, lang)
+        if not documents:
+            print(f"{name}: no documents found")
+            continue
+        legacy_calls = packed_calls = legacy_overflow = packed_overflow = 0
+        for doc_id, sentences in documents.items():
+            prompt_tokens = count_tokens(
+                question_and_reason_prompt["en"].format(
+                    query=query, text="", extra=memory_wrapper.format(extra=""), doc_id=doc_id
+                )
+            )
+            budget = get_token_budget(llm_ctx_len, new_tokens, prompt_tokens, memory_tokens)
+
+            legacy = legacy_sentence_batches(sentences, llm_ctx_len // 4)
+            legacy_calls += len(legacy)
+            legacy_overflow += sum(
+                count_tokens(" ".join(batch)) > budget for batch in legacy.values()
+            )
+
+            packed = get_sentence_batches(sentences, budget, count_tokens)
+            packed_calls += len(packed["batches"])
+            packed_overflow += sum(
+                count_tokens(" ".join(batch)) > budget
+                for batch in packed["batches"].values()
+            )
+
+        saved = legacy_calls - packed_calls
+        print(
+            f"{name:>12}: {len(documents)} docs, legacy {legacy_calls} calls "
+            f"({legacy_overflow} over budget), packed {packed_calls} calls "
+            f"({packed_overflow} over budget), saved {saved} calls"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip", default=None, help="llama.cpp server for /tokenize")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--ctx", type=int, default=8168)
+    parser.add_argument("--new-tokens", type=int, default=4096)
+    parser.add_argument("--lang", default="norwegian")
+    args = parser.parse_args()
+    run(
+        ip_address=args.ip,
+        port=args.port,
+        llm_ctx_len=args.ctx,
+        new_tokens=args.new_tokens,
+        lang=args.lang,
+    )
@@ -0,0 +1,109 @@
+# ------------------------------------------------------------------------------
+# File: encode.py
+# Description: compares the fp32 and int8 OpenVINO embedding models on encode
+#              throughput and on how often they retrieve the same sentences.
+#
+# Usage (from src/): python install.py --int8, then
+#                    python -m benchmarks.encode --corpus ../data/20-examples
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import random
+import time
+from typing import Dict, List
+
+import dotenv
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from utils.embeddings import OPENVINO_FILES
+from utils.parse import iter_documents, iter_folder_documents, list_document_files
+from utils.quantize import _top_k
+
+dotenv.load_dotenv()
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+
+
+def load_model(model_path: str, precision: str) -> SentenceTransformer:
+    return SentenceTransformer(
+        model_path,
+        backend="openvino",
+        model_kwargs={"file_name": OPENVINO_FILES[precision]},
+        local_files_only=True,
+    )
+
+
+def encode(model: SentenceTransformer, texts: List[str], batch_size: int) -> np.ndarray:
+    return model.encode(
+        texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True
+    )
+
+
+def top_k_agreement(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    # mean overlap of the top-k sets found by two rankings
+    k = min(k, a.shape[1])
+    top_a, top_b = _top_k(a, k), _top_k(b, k)
+    return float(np.mean([len(set(x) & set(y)) / k for x, y in zip(top_a, top_b)]))
+
+
+def run(
+    corpus: str,
+    queries_path: str,
+    model_path: str = "sbert",
+    lang: str = "norwegian",
+    n_queries: int = 100,
+    batch_size: int = 32,
+    ks=(1, 10, 100),
+):
+    paths = list_document_files(corpus)
+    sentences = [
+        r["text"] for _, rs in iter_documents(iter_folder_documents(paths), lang) for r in rs
+    ]
+    queries = random.Random(0).sample(sentences, min(n_queries, len(sentences)))
+    if os.path.exists(queries_path):
+        with open(queries_path, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()] + queries
+    print(f"{len(sentences)} sentences from {len(paths)} files, {len(queries)} queries")
+
+    vectors: Dict[str, np.ndarray] = {}
+    query_vectors: Dict[str, np.ndarray] = {}
+    for precision in OPENVINO_FILES:
+        model = load_model(model_path, precision)
+        encode(model, sentences[: batch_size * 2], batch_size)  # warm-up
+        start = time.perf_counter()
+        vectors[precision] = encode(model, sentences, batch_size)
+        elapsed = time.perf_counter() - start
+        query_vectors[precision] = encode(model, queries, batch_size)
+        print(f"{precision:>5}: {len(sentences) / elapsed:8.1f} sentences/s")
+
+    fp32, int8 = vectors["fp32"], vectors["int8"]
+    cosines = np.sum(fp32 * int8, axis=1)
+    print(f"cosine(fp32, int8): mean {cosines.mean():.4f}, min {cosines.min():.4f}")
+    scores = {p: query_vectors[p] @ vectors[p].T for p in OPENVINO_FILES}
+    for k in ks:
+        agreement = top_k_agreement(scores["fp32"], scores["int8"], k)
+        print(f"top-{k} agreement with fp32: {agreement:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(DATA_FOLDER, "20-examples"))
+    parser.add_argument("--queries", default=os.path.join(DATA_FOLDER, "example-queries.txt"))
+    parser.add_argument("--model", default="sbert")
+    parser.add_argument("--lang", default="norwegian")
+    parser.add_argument("--n-queries", type=int, default=100, help="sampled sentence queries")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+    run(
+        args.corpus,
+        args.queries,
+        model_path=args.model,
+        lang=args.lang,
+        n_queries=args.n_queries,
+        batch_size=args.batch_size,
+    )
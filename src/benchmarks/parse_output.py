@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------------
+# File: parse_output.py
+# Description: micro-benchmark of parse_llm_output over recorded LLM outputs.
+#              Reports parse throughput and the recovered-vs-dropped rate for
+#              well-formed, fenced, python-style and truncated outputs.
+#
+# Usage (from src/): python -m benchmarks.parse_output [--repeat 20]
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import argparse
+import glob
+import json
+import os
+import random
+import time
+from typing import Callable, Dict, List
+
+from llm import LLMOutputError, parse_llm_output
+
+RECORDED_OUTPUTS = os.path.join(
+    os.path.dirname(__file__), "..", "..", "evaluation", "output_llm_check"
+)
+
+
+def load_recorded_outputs(folder: str = RECORDED_OUTPUTS) -> List[dict]:
+    outputs = []
+    for path in sorted(glob.glob(os.path.join(folder, "**", "*.jsonl"), recursive=True)):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if isinstance(record.get("llm_output"), dict):
+                    outputs.append(record["llm_output"])
+    return outputs
+
+
+def _truncate(text: str, rng: random.Random) -> str:
+    # cut somewhere in the second half, as n_predict would
+    return text[: rng.randint(len(text) // 2, len(text) - 1)]
+
+
+variants: Dict[str, Callable[[dict, random.Random], str]] = {
+    "json": lambda o, rng: json.dumps(o, ensure_ascii=False),
+    "json-pretty": lambda o, rng: json.dumps(o, ensure_ascii=False, indent=2),
+    "fenced": lambda o, rng: f"```json\n{json.dumps(o, ensure_ascii=False)}\n```",
+    "python": lambda o, rng: repr(o),
+    "truncated": lambda o, rng: _truncate(json.dumps(o, ensure_ascii=False), rng),
+}
+
+
+def run(repeat: int = 20, use_schema: str = "default", seed: int = 42):
+    outputs = load_recorded_outputs()
+    if not outputs:
+        raise ValueError(f"No recorded outputs found in {RECORDED_OUTPUTS}")
+    print(f"Loaded {len(outputs)} recorded outputs.")
+    rng = random.Random(seed)
+
+    for name, make in variants.items():
+        texts = [make(o, rng) for o in outputs]
+        n_bytes = sum(len(t.encode("utf-8")) for t in texts)
+        recovered = dropped = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                try:
+                    parse_llm_output(text, use_schema=use_schema)
+                    recovered += 1
+                except LLMOutputError:
+                    dropped += 1
+        elapsed = time.perf_counter() - start
+        total = recovered + dropped
+        print(
+            f"{name:>12}: {total / elapsed:10.0f} outputs/s "
+            f"{n_bytes * repeat / elapsed / 1e6:7.1f} MB/s "
+            f"recovered {recovered / total:6.1%} dropped {dropped / total:6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--schema", default="default")
+    args = parser.parse_args()
+    run(repeat=args.repeat, use_schema=args.schema)
@@ -0,0 +1,82 @@
+# ------------------------------------------------------------------------------
+# File: quantization.py
+# Description: index size and recall of float16/int8 embedding storage
+#              against exact float32 search, with and without full-precision
+#              re-scoring, on a corpus of case files.
+#
+# Usage (from src/): python -m benchmarks.quantization --corpus ../data/20-examples
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import random
+import time
+
+import dotenv
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from utils.parse import iter_documents, iter_folder_documents, list_document_files
+from utils.quantize import STORAGE_DTYPES, QuantizedVectors
+
+dotenv.load_dotenv()
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+
+
+def recall(found: np.ndarray, exact: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact)]))
+
+
+def run(
+    corpus: str,
+    model_path: str = "sbert",
+    lang: str = "norwegian",
+    n_queries: int = 200,
+    ks=(10, 50),
+):
+    paths = list_document_files(corpus)
+    sentences = [
+        r["text"]
+        for _, records in iter_documents(iter_folder_documents(paths), lang)
+        for r in records
+    ]
+    with open(os.path.join(DATA_FOLDER, "example-queries.txt"), "r", encoding="utf-8") as f:
+        queries = [q.strip() for q in f if q.strip()]
+    # sentences of the corpus as extra queries, for a stable recall estimate
+    queries += random.Random(0).sample(sentences, min(n_queries, len(sentences)))
+
+    model = SentenceTransformer(model_path, backend="openvino", local_files_only=True)
+    vectors = model.encode(sentences, batch_size=32, normalize_embeddings=True)
+    query_vectors = model.encode(queries, batch_size=32, normalize_embeddings=True)
+    print(f"{len(sentences)} sentences, {len(queries)} queries, dim {vectors.shape[1]}")
+
+    exact = QuantizedVectors.from_float(vectors, "float32")
+    for k in ks:
+        truth, _ = exact.search(query_vectors, k)
+        for dtype in STORAGE_DTYPES:
+            index = QuantizedVectors.from_float(vectors, dtype)
+            for rescore in (False, True):
+                start = time.perf_counter()
+                found, _ = index.search(query_vectors, k, full=vectors if rescore else None)
+                elapsed = time.perf_counter() - start
+                print(
+                    f"k={k:<3} {dtype:>7} rescore={str(rescore):<5} "
+                    f"{index.nbytes / 2**20:7.2f} MiB "
+                    f"({exact.nbytes / index.nbytes:.1f}x smaller) "
+                    f"recall {recall(found, truth):.4f} "
+                    f"{elapsed * 1000 / len(queries):.2f} ms/query"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(DATA_FOLDER, "20-examples"))
+    parser.add_argument("--model", default="sbert")
+    parser.add_argument("--lang", default="norwegian")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    run(args.corpus, model_path=args.model, lang=args.lang, n_queries=args.queries)
@@ -0,0 +1,171 @@
+# ------------------------------------------------------------------------------
+# File: vector_stores.py
+# Description: compares the Chroma and local (memory-mapped) vector stores on
+#              open time, ingest throughput, query latency and disk size.
+#
+# Usage (from src/): python -m benchmarks.vector_stores --corpus ../data/20-examples
+#                    --random skips the embedding model (random vectors)
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import chromadb
+import dotenv
+import numpy as np
+from chromadb.config import Settings
+
+from utils.ingest import chunked
+from utils.parse import iter_documents, iter_folder_documents, list_document_files
+from utils.vectorstore import ChromaStore, LocalStore, VectorStore
+
+dotenv.load_dotenv()
+
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+
+
+def folder_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+    )
+
+
+def open_chroma(path: str, embed: Callable) -> VectorStore:
+    class Embedder(chromadb.EmbeddingFunction):
+        def __call__(self, input):
+            return list(embed(input))
+
+    client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+    collection = client.get_or_create_collection(name="bench", embedding_function=Embedder())
+    return ChromaStore(collection)
+
+
+def bench(
+    name: str,
+    open_store: Callable[[], VectorStore],
+    path: str,
+    records: List[Dict],
+    vectors: np.ndarray,
+    queries: List[str],
+    n_results: int,
+    chunk_size: int = 512,
+):
+    start = time.perf_counter()
+    store = open_store()
+    open_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for rows in chunked(range(len(records)), chunk_size):
+        store.add(
+            ids=[f"{i}-{records[i]['id']}-{records[i]['sent_id']}" for i in rows],
+            embeddings=vectors[rows[0] : rows[-1] + 1],
+            metadatas=[
+                {
+                    "document": records[i]["id"],
+                    "sent_id": records[i]["sent_id"],
+                    "page_id": records[i]["page_id"],
+                }
+                for i in rows
+            ],
+            documents=[records[i]["text"] for i in rows],
+        )
+    store.flush()
+    ingest_s = time.perf_counter() - start
+    del store
+
+    # reopen, as a new session would
+    start = time.perf_counter()
+    store = open_store()
+    reopen_s = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        store.query([query], n_results)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+
+    start = time.perf_counter()
+    store.get_by_document([records[0]["id"]])
+    get_ms = (time.perf_counter() - start) * 1000
+
+    print(
+        f"{name:>16}: open {open_s * 1000:7.1f} ms, reopen {reopen_s * 1000:7.1f} ms, "
+        f"ingest {len(records) / ingest_s:8.0f} sent/s, "
+        f"query p50 {np.percentile(latencies, 50):6.2f} ms "
+        f"p95 {np.percentile(latencies, 95):6.2f} ms, "
+        f"get_by_document {get_ms:6.2f} ms, {folder_size(path) / 2**20:6.1f} MiB on disk"
+    )
+
+
+def run(
+    corpus: str,
+    model_path: str = "sbert",
+    lang: str = "norwegian",
+    n_queries: int = 100,
+    n_results: int = 100,
+    use_random: bool = False,
+):
+    paths = list_document_files(corpus)
+    records = [r for _, rs in iter_documents(iter_folder_documents(paths), lang) for r in rs]
+    queries = [r["text"] for r in random.Random(0).sample(records, min(n_queries, len(records)))]
+
+    if use_random:
+        rng = np.random.default_rng(0)
+        cache: Dict[str, np.ndarray] = {}
+
+        def embed(texts: List[str]) -> np.ndarray:
+            return np.stack(
+                [cache.setdefault(t, rng.normal(size=768).astype(np.float32)) for t in texts]
+            )
+
+    else:
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_path, backend="openvino", local_files_only=True)
+
+        def embed(texts: List[str]) -> np.ndarray:
+            return model.encode(texts, batch_size=32, convert_to_numpy=True)
+
+    # embeddings are computed once, so ingest measures the stores only
+    vectors = np.asarray(embed([r["text"] for r in records]), dtype=np.float32)
+    print(f"{len(records)} sentences from {len(paths)} files, {len(queries)} queries")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {
+            "chroma": lambda path: open_chroma(path, embed),
+            "local float32": lambda path: LocalStore(path, embed),
+            "local int8": lambda path: LocalStore(path, embed, dtype="int8"),
+            "local int8 rescore": lambda path: LocalStore(path, embed, dtype="int8", rescore=True),
+            "local float16": lambda path: LocalStore(path, embed, dtype="float16"),
+            "local hnsw": lambda path: LocalStore(path, embed, hnsw=True),
+        }
+        for name, open_store in stores.items():
+            path = os.path.join(tmp, name.replace(" ", "-"))
+            bench(name, lambda: open_store(path), path, records, vectors, queries, n_results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(DATA_FOLDER, "20-examples"))
+    parser.add_argument("--model", default="sbert")
+    parser.add_argument("--lang", default="norwegian")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-results", type=int, default=100)
+    parser.add_argument("--random", action="store_true", help="random vectors, no model")
+    args = parser.parse_args()
+    run(
+        args.corpus,
+        model_path=args.model,
+        lang=args.lang,
+        n_queries=args.queries,
+        n_results=args.n_results,
+        use_random=args.random,
+    )
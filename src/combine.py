@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import re
@@ -5,7 +6,7 @@ from typing import Any, Dict, List, Tuple
 
 import pandas as pd
 
-from llm import pred
+from llm import pred_async
 
 MIN_TOKENS: int = 100  # min summary tokens
 MAX_TOKENS: int = 2000  # output tokens
@@ -15,11 +16,14 @@ processing_prompt: str = (
 )
 
 
-def process_case(case_jsonl_path: str, ip_address: str, port: int) -> Tuple[str, Dict[str, Any]]:
+async def process_case(case_jsonl_path: str, ip_address: str, port: int) -> Tuple[str, Dict[str, Any]]:
     doc_findings: List[Dict[str, Any]] = []
     with open(case_jsonl_path, "r", encoding="utf-8") as f:
         doc_findings = [json.loads(x) for x in f.readlines()]
     print(f"Found {len(doc_findings)} answers.")
+    if not doc_findings:
+        # e.g. every batch was skipped by the relevance triage
+        return "", {}
     doc_df = pd.DataFrame(doc_findings)
     doc_df = pd.concat(
         [
@@ -33,7 +37,7 @@ def process_case(case_jsonl_path: str, ip_address: str, port: int) -> Tuple[str,
     summaries: List[str] = doc_df["summary"].unique().tolist()
     text: str = "\n".join(summaries)
     instruction: str = processing_prompt.format(text=text, query=query)
-    output: Dict[str, Any] = pred(
+    output: Dict[str, Any] = await pred_async(
         instruction,
         ip_address=ip_address,
         port=port,
@@ -42,11 +46,20 @@ def process_case(case_jsonl_path: str, ip_address: str, port: int) -> Tuple[str,
     return query, output
 
 
-def meta_summary(case_path: str, ip_address: str, port: int) -> List[Dict[str, Any]]:
+async def _meta_summary(case_path: str, ip_address: str, port: int) -> List[Dict[str, Any]]:
+    # one task per query file; the llm client bounds how many run at once
+    files = sorted(os.listdir(case_path))
+    tasks = [
+        process_case(os.path.join(case_path, f), ip_address=ip_address, port=port)
+        for f in files
+    ]
     metas: List[Dict[str, Any]] = []
-    for f in os.listdir(case_path):
-        full_path: str = os.path.join(case_path, f)
-        query, processed = process_case(full_path, ip_address=ip_address, port=port)
+    # a failed query only loses its own meta-summary
+    for f, result in zip(files, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(result, Exception):
+            print(f"Skipping meta-summary of {f}: {result!r}")
+            continue
+        query, processed = result
         if "summary" in processed:
             metas.append(
                 {
@@ -55,3 +68,7 @@ def meta_summary(case_path: str, ip_address: str, port: int) -> List[Dict[str, A
                 }
             )
     return metas
+
+
+def meta_summary(case_path: str, ip_address: str, port: int) -> List[Dict[str, Any]]:
+    return asyncio.run(_meta_summary(case_path, ip_address=ip_address, port=port))
@@ -1,170 +1,225 @@
+import io
 import os
-import shutil
 import zipfile
-from typing import Dict, List, Tuple
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
-import nltk
-import pandas as pd
 import streamlit as st
 from chromadb import PersistentClient
-from chromadb.types import Collection
-from chromadb.utils.batch_utils import create_batches
-from sentence_transformers import SentenceTransformer
 
-from utils.chroma import get_client
+from utils.bm25 import BM25Builder, load_bm25_index, save_bm25_index
+from utils.catalog import build_catalog, diff_catalogs, get_catalog, save_catalog
+from utils.chroma import get_store
+from utils.embeddings import get_embedding_cache
+from utils.ingest import CHUNK_SIZE, StageTimer, chunked
+from utils.parse import (
+    VALID_EXTS,
+    iter_documents,
+    iter_zip_documents,
+    parse_workers,
+    read_documents,
+    zip_members,
+)
+from utils.resources import get_embedding_model, warm_up
+from utils.vectorstore import VectorStore
 
 EMBEDDING_MODEL = "sbert"
+# fp32, or int8 once exported with `python install.py --int8`
+EMBEDDING_PRECISION = os.environ.get("EMBEDDING_PRECISION", "fp32")
 LANG = "english"
-
-valid_exts = [".txt", ".json", ".jsonl"]
-
-with st.spinner("Loading SentenceTransformer model..."):
-    embedding_model = SentenceTransformer(
-        EMBEDDING_MODEL,
-        backend="openvino",  # we optimize cpu-inference to reduce docker container image (w/ cuda drivers etc.)
-        local_files_only=True,
-    )
-
-
-def load_txt_from_folder(folder_path: str, lang: str = LANG) -> pd.DataFrame:
-    # walk all files in the directory!
-    parsed_data = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith(".txt"):
-                with open(os.path.join(root, file), "r", encoding="utf-8") as f:
-                    _doc = f.readlines()
-                    filename_no_ext = os.path.splitext(file)[0]
-                    parsed_data.extend(parse_document(_doc, lang, document_name=filename_no_ext))
-
-    return pd.DataFrame(parsed_data)
-
-
-def parse_document(
-    docs: List[str],
-    lang: str = LANG,
-    strip_newlines: bool = True,
-    document_name: str = "",
-) -> List[str]:
-    if strip_newlines:
-        print(f"Stripping newlines from {len(docs)} documents.")
-        docs = [d.replace("\n", "") for d in docs]
-
-    def sentencize(text):
-        return nltk.sent_tokenize(text, language=lang)
-
-    parsed_data = []
-    sentences = []
-    paragraph_sent_map = []
-    for d_id, paragraph in enumerate(docs):
-        d_sents = sentencize(paragraph)
-        paragraph_sent_map.extend([d_id] * len(d_sents))
-        sentences.extend(d_sents)
-
-    for s_id, sent in enumerate(sentences):
-        _d_id = paragraph_sent_map[s_id]
-        parsed_data.append(
-            {
-                "id": document_name,
-                "page_id": _d_id,
-                "sent_id": s_id,
-                "text": sent,
-            }
-        )
-
-    return parsed_data
+# processes splitting sentences of large uploads (small ones are parsed in-process)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+# chroma, or local (memory-mapped, see utils/vectorstore.py) with optional
+# float16/int8 scanning and an hnsw graph
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "chroma")
+VECTOR_DTYPE = os.environ.get("VECTOR_DTYPE", "float32")
+VECTOR_HNSW = os.environ.get("VECTOR_HNSW", "0") == "1"
+# float16/int8: also keep float32 vectors to re-score with (larger store)
+VECTOR_RESCORE = os.environ.get("VECTOR_RESCORE", "0") == "1"
+# load the model, chroma client and punkt in the background on the first page
+# view, instead of on the first ingestion (set in the docker images)
+WARMUP = os.environ.get("WARMUP", "0") == "1"
+
+valid_exts = list(VALID_EXTS)
+
+
+def embedding_model():
+    # loaded once per process, on first use (see utils/resources.py)
+    return get_embedding_model(EMBEDDING_MODEL, EMBEDDING_PRECISION)
+
+
+def warm_up_resources(langs: Iterable[str] = (LANG,)):
+    if WARMUP:
+        warm_up(EMBEDDING_MODEL, EMBEDDING_PRECISION, langs)
+
+
+class UploadRecords:
+    """
+    Re-iterable stream of sentence records from an uploaded file (.txt,
+    .json, .jsonl or a .zip of them), decoded from the upload's bytes on
+    each pass. Nothing is written to disk, so sessions never share files.
+    """
+
+    def __init__(self, filename: str, payload: bytes, lang: str = LANG, workers: int = 1):
+        self.filename = filename
+        self.payload = payload
+        self.lang = lang
+        self.is_zip = filename.lower().endswith(".zip")
+        if self.is_zip:
+            with zipfile.ZipFile(io.BytesIO(payload)) as z:
+                size = sum(i.file_size for i in zip_members(z))
+        else:
+            size = len(payload)
+        self.workers = parse_workers(size, workers)
+
+    def documents(self) -> Iterator[Tuple[str, List[str]]]:
+        if self.is_zip:
+            with zipfile.ZipFile(io.BytesIO(self.payload)) as z:
+                yield from iter_zip_documents(z)
+        else:
+            yield from read_documents(self.filename, io.BytesIO(self.payload))
+
+    def __iter__(self) -> Iterator[Dict[str, any]]:
+        for _, records in iter_documents(self.documents(), self.lang, self.workers):
+            yield from records
 
 
 @st.cache_data
 def load_and_cache_documents(uploaded_file, lang: str):
     print(f"Loading: {uploaded_file.name} with language: {lang}")
-    ext = uploaded_file.name.split(".")[-1] if uploaded_file else None
-    filename = uploaded_file.name.split(".")[0] if uploaded_file else None
-    df = pd.DataFrame()
-    if ext == "txt":
-        uploaded_file = uploaded_file.read().decode("utf-8")
-        print(f"Loaded single document with {len(uploaded_file)} paragraphs.")
-
-        df = pd.DataFrame(parse_document(uploaded_file, lang=lang, document_name=filename))
-
-    elif ext == "zip":
-        with zipfile.ZipFile(uploaded_file, "r") as z:
-            # remove the temp folder if it exists
-            if os.path.exists("temp"):
-                shutil.rmtree("temp", ignore_errors=True)
-            z.extractall("temp")
-            df = load_txt_from_folder("temp")
-
-    if df.empty:
+    # records are streamed from the upload; only the catalog is kept in memory
+    data = UploadRecords(
+        uploaded_file.name, uploaded_file.getvalue(), lang=lang, workers=PARSE_WORKERS
+    )
+    catalog = build_catalog(data)
+    if not catalog:
         raise ValueError("No data found in the uploaded file.")
 
-    print(f"Loaded {len(df)} documents.")
-    # columns: id/page_id/sent_id/text
-    num_docs = df["id"].nunique()
-    num_pages = df["page_id"].nunique()
-    num_sents = df.shape[0]
+    num_docs = len(catalog)
+    num_pages = sum(c["pages"] for c in catalog.values())
+    num_sents = sum(c["sentences"] for c in catalog.values())
     st.info(f"Found {num_docs} documents, {num_pages} paragraphs, and {num_sents} sentences")
     return {
-        "data": df.to_dict(orient="records"),
+        "data": data,
+        "catalog": catalog,
         "num_pages": num_pages,
         "num_sents": num_sents,
     }
 
 
+def _add_records(
+    collection: VectorStore,
+    data: Iterable[Dict[str, any]],
+    n_sents: int,
+    BATCH_SIZE: int = 32,
+    chunk_size: int = CHUNK_SIZE,
+):
+    # file -> sentences -> chunks -> embeddings -> chroma, one chunk in memory at a time
+    model = embedding_model()
+    cache = get_embedding_cache(
+        EMBEDDING_MODEL,
+        model.get_sentence_embedding_dimension(),
+        precision=EMBEDDING_PRECISION,
+    )
+    encode = partial(model.encode, batch_size=BATCH_SIZE)
+    timer = StageTimer()
+    progress_bar = st.progress(0, text="Computing embeddings...")
+    done = 0
+    for chunk in chunked(timer.iterate("read", data), chunk_size):
+        documents = [d["text"] for d in chunk]
+        with timer.stage("encode", len(chunk)):
+            # only sentences this model has not embedded before are encoded
+            embeddings = cache.encode(documents, encode) if cache else encode(documents)
+
+        with timer.stage("add", len(chunk)):
+            collection.add(
+                # a reference key for each document
+                ids=[
+                    f"{done + d_id}-{d['id']}-{d['page_id']}-{d['sent_id']}"
+                    for d_id, d in enumerate(chunk)
+                ],
+                embeddings=embeddings,
+                metadatas=[
+                    {
+                        "document": d["id"],
+                        "sent_id": d["sent_id"],
+                        "page_id": d["page_id"],
+                    }
+                    for d in chunk
+                ],
+                documents=documents,
+            )
+        done += len(chunk)
+        progress_bar.progress(
+            min(done / max(n_sents, 1), 1.0), text=f"Embedded {done}/{n_sents} sentences"
+        )
+    progress_bar.empty()
+    print(f"Ingestion throughput: {timer.report()}")
+
+
 def populate_collection(
-    data: List[Dict[str, any]],
+    data: Iterable[Dict[str, any]],  # re-iterable, e.g. a list or UploadRecords
     collection_name: str,
     delete=False,
     BATCH_SIZE=32,
-) -> Tuple[PersistentClient, Collection]:
-    client, collection = get_client(
-        persist=True,  # persist: store to disk (under the `chroma` folder)
+    lang: str = LANG,  # tokenization of the bm25 index
+    chunk_size: int = CHUNK_SIZE,
+    catalog: Dict[str, Dict[str, Any]] = None,  # build_catalog(data), if already known
+) -> Tuple[PersistentClient, VectorStore]:
+    client, collection = get_store(
+        backend=VECTOR_STORE,
         delete=delete,  # WARNING: enable ONLY if doing changes to the data
-        embedding_model=embedding_model,
+        embedding_model=embedding_model(),
         collection_name=collection_name,
+        dtype=VECTOR_DTYPE,
+        hnsw=VECTOR_HNSW,
+        rescore=VECTOR_RESCORE,
     )
-    if collection.count() == 0:
-        document_meta = []
-        meta_text = "Adding metadata..."
-        meta_bar = st.progress(0, text=meta_text)
-        for percent_complete, row in enumerate(data):
-            print(f"Adding metadata for document: {row['id']}")
-            document_meta.append(
-                {
-                    "document": row["id"],
-                    "sent_id": row["sent_id"],
-                    "page_id": row["page_id"],
-                }
-            )
-            current_perc = (percent_complete + 1) / len(data)
-            current_perc = min(current_perc, 1.0)
-            meta_bar.progress(current_perc)
-        meta_bar.empty()
-
-        documents = [d["text"] for d in data]
-
-        with st.spinner("Computing embeddings..."):
-            embeddings = embedding_model.encode(
-                documents,
-                show_progress_bar=True,
-                batch_size=BATCH_SIZE,
-            ).tolist()
-
-        # a reference key for each document
-        ids = []
-        for d_id, d in enumerate(data):
-            ids.append(f"{d_id}-{d['id']}-{d['page_id']}-{d['sent_id']}")
-
-        batches = create_batches(
-            api=client,
-            ids=ids,
-            embeddings=embeddings,
-            metadatas=document_meta,
-            documents=documents,
+    # sync the collection with the upload, document by document
+    if catalog is None:
+        catalog = build_catalog(data)
+    stored = get_catalog(collection) if collection.count() > 0 else {}
+    changes = diff_catalogs(stored, catalog)
+    stale = changes["removed"] + changes["changed"]
+    fresh = set(changes["added"] + changes["changed"])
+    print(f"Collection {collection_name}: {changes}")
+
+    # one pass over the records (none if nothing changed): new sentences go
+    # to the vector store, and all of them to the keyword index
+    reindex = bool(stale or fresh) or load_bm25_index(collection_name) is None
+    bm25 = BM25Builder(lang) if reindex else None
+
+    def records() -> Iterator[Dict[str, any]]:
+        for d in data:
+            bm25.add(d)
+            if d["id"] in fresh:
+                yield d
+
+    if stale:
+        collection.delete(stale)
+    if fresh:
+        _add_records(
+            collection,
+            records(),
+            n_sents=sum(catalog[d]["sentences"] for d in fresh),
+            BATCH_SIZE=BATCH_SIZE,
+            chunk_size=chunk_size,
         )
-
-        # i: index, e: embedding, m: metadata, d: document
-        for i, e, m, d in batches:
-            collection.add(i, e, m, d)
+    elif reindex:
+        for _ in records():
+            pass
+    # persisted once per sync, not per chunk (see LocalStore.flush)
+    collection.flush()
+
+    if reindex:
+        # compact document listing next to the collection, see utils/catalog.py
+        save_catalog(collection_name, catalog)
+        with st.spinner("Building keyword index..."):
+            save_bm25_index(collection_name, bm25.build())
+    st.info(
+        f"Collection {collection_name}: {len(changes['added'])} documents added, "
+        f"{len(changes['changed'])} updated, {len(changes['removed'])} removed, "
+        f"{len(changes['unchanged'])} unchanged"
+    )
 
     return client, collection
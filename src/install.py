@@ -1,3 +1,9 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
 import dotenv
 import nltk
 from sentence_transformers import SentenceTransformer
@@ -5,6 +11,61 @@ from sentence_transformers import SentenceTransformer
 dotenv.load_dotenv()
 
 EMBEDDING_MODEL = "intfloat/multilingual-e5-base"
+MODEL_FOLDER = "sbert"
+INT8_FILE = "openvino_model_qint8_quantized"  # see utils.embeddings.OPENVINO_FILES
+CALIBRATION_FOLDER = os.path.join("..", "data", "20-examples")
+
+
+def calibration_sentences(folder: str, n_samples: int, lang: str = "norwegian"):
+    from utils.parse import iter_documents, iter_folder_documents, list_document_files
+
+    sentences = [
+        r["text"]
+        for _, records in iter_documents(iter_folder_documents(list_document_files(folder)), lang)
+        for r in records
+    ]
+    return random.Random(0).sample(sentences, min(n_samples, len(sentences)))
+
+
+def export_int8(model: SentenceTransformer, sentences, max_length: int = 128):
+    # static post-training quantization of the openvino model (weights and
+    # activations), calibrated on sentences like the ones we will embed
+    try:
+        from datasets import Dataset
+        from optimum.intel import OVConfig, OVQuantizationConfig, OVQuantizer
+    except ImportError as e:
+        raise SystemExit(f"{e}. Install the int8 export dependencies: pip install -r requirements.int8.txt")
+
+    tokenizer = model.tokenizer
+    dataset = Dataset.from_dict({"text": sentences}).map(
+        lambda batch: tokenizer(
+            batch["text"], padding="max_length", max_length=max_length, truncation=True
+        ),
+        batched=True,
+        remove_columns=["text"],
+    )
+    quantizer = OVQuantizer.from_pretrained(model[0].auto_model)
+    with tempfile.TemporaryDirectory() as tmp:
+        quantizer.quantize(
+            save_directory=tmp,
+            calibration_dataset=dataset,
+            ov_config=OVConfig(quantization_config=OVQuantizationConfig(num_samples=len(dataset))),
+        )
+        target = os.path.join(MODEL_FOLDER, "openvino")
+        os.makedirs(target, exist_ok=True)
+        for ext in (".xml", ".bin"):
+            shutil.copyfile(
+                os.path.join(tmp, f"openvino_model{ext}"), os.path.join(target, f"{INT8_FILE}{ext}")
+            )
+    print(f"Saved int8 model to {target}/{INT8_FILE}.xml ({len(dataset)} calibration sentences)")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--int8", action="store_true", help="also export an int8 quantized model")
+parser.add_argument("--calibration", default=CALIBRATION_FOLDER, help="documents to calibrate on")
+parser.add_argument("--samples", type=int, default=300, help="calibration sentences")
+args = parser.parse_args()
+
 # https://huggingface.co/intfloat/multilingual-e5-base/discussions/24
 pr_number = 24
 model = SentenceTransformer(
@@ -13,7 +74,14 @@ model = SentenceTransformer(
     backend="openvino",  # we optimize cpu-inference to reduce docker container image (w/ cuda drivers etc.)
 )
 
-model.save_pretrained("sbert")
+model.save_pretrained(MODEL_FOLDER)
 model_home = "models"
 nltk.download("punkt", download_dir=model_home)
 nltk.download("punkt_tab", download_dir=model_home)
+
+if args.int8:
+    if not os.path.isdir(args.calibration):
+        raise SystemExit(f"Calibration folder {args.calibration} not found, see --calibration")
+    if model_home not in nltk.data.path:
+        nltk.data.path.append(model_home)
+    export_int8(model, calibration_sentences(args.calibration, args.samples))
@@ -9,19 +9,59 @@
 # - Tollef Jørgensen (Initial Development, 2024)
 # ------------------------------------------------------------------------------
 
+import ast
+import asyncio
+import bisect
+import hashlib
 import json
+import math
+import os
+import random
 import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from typing import Any, Dict, Hashable, Iterator, List, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 
+# prompts keep the shared instructions (and the query) first, and the per-call
+# variables last, so llama.cpp can reuse the KV cache of the common prefix.
+# The memory ({extra}) follows the document text, so a triage call on the same
+# text (which has no memory) shares the prefix up to and including the text.
 question_and_reason_prompt = {
-    "en": "You are an AI assisting a criminal investigation, analyzing case files for knowledge discoveries. You follow strict logical and deductive reasoning, and will only present information for which you have a complete overview of. Do not make assumptions, or add any superfluous information. {extra}You receive a new document with ID {doc_id}: '{text}'. Investigate document {doc_id} grounded in the QUERY: '{query}'. Generate a JSON object with 1) questions: a list of investigative questions (based on e.g., objects, actions, events, entities) that are directly related to the QUERY in {doc_id}. 2) reason: discuss whether document {doc_id} answers the QUERY. 3) score: if the document is 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant. 4) a summary of vital details uncovered in {doc_id}.",
+    "en": "You are an AI assisting a criminal investigation, analyzing case files for knowledge discoveries. You follow strict logical and deductive reasoning, and will only present information for which you have a complete overview of. Do not make assumptions, or add any superfluous information. Investigate each document you receive grounded in the QUERY: '{query}'. Generate a JSON object with 1) questions: a list of investigative questions (based on e.g., objects, actions, events, entities) that are directly related to the QUERY in the document. 2) reason: discuss whether the document answers the QUERY. 3) score: if the document is 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant. 4) a summary of vital details uncovered in the document. You receive a new document with ID {doc_id}: '{text}'. {extra}Investigate document {doc_id} grounded in the QUERY.",
 }
-memory_prompt = "You are an AI assisting a criminal investigation, analyzing case files. You follow abductive reasoning and logic. Do not make assumptions, or add any superfluous information. From the following data:\n{previous_information}, create a summary of vital information related to the query: '{query}'. Make sure to reference the ID '{DOC_ID}' for your findings, and keep all previous document references."
+memory_wrapper = "You have info from previous interrogations: '{extra}'. Use this info to guide your reasoning if relevant. "
+# appended to question_and_reason_prompt, so the triage call shares its prefix
+triage_suffix = {
+    "en": " Before anything else, give only the relevance score of document {doc_id} to the QUERY: 0 irrelevant, 1 somewhat relevant, 2 relevant, or 3 extremely relevant. Score:",
+}
+memory_prompt = "You are an AI assisting a criminal investigation, analyzing case files. You follow abductive reasoning and logic. Do not make assumptions, or add any superfluous information. Create a summary of vital information related to the query: '{query}'. Make sure to reference the ID '{DOC_ID}' for your findings, and keep all previous document references. From the following data:\n{previous_information}"
 
 
 headers = {"Content-Type": "application/json"}
 
+# persistent cache of deterministic completions, see `CompletionCache`
+LLM_CACHE_PATH = os.path.join("cache", "llm_completions.sqlite")
+LLM_CACHE_MAX_MB = 256
+# seconds before server props (incl. the model keying cached completions) are re-read
+PROPS_TTL = 60.0
+# request options that do not affect the generated text
+_UNCACHED_KEYS = ("stream", "cache_prompt", "id_slot")
+# retries of failed llm calls, with exponential backoff (seconds)
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 1.0
+RETRY_BACKOFF_MAX = 30.0
+# bounded repair passes for malformed/truncated llm output
+MAX_REPAIR_ATTEMPTS = 4
+# slot affinities remembered per server
+MAX_SLOT_KEYS = 1024
+
 schema = {
     "type": "object",
     "properties": {
@@ -74,6 +114,693 @@ schemas = {
 }
 
 
+class LLMClient:
+    """
+    Pooled client for a single llama.cpp server.
+
+    A `requests.Session` keeps connections alive between calls, and the async
+    API caps in-flight requests to the number of server slots (`-np N`).
+    """
+
+    def __init__(
+        self,
+        ip_address: str,
+        port: int,
+        n_slots: int = None,  # None: ask the server (/props)
+        timeout: float = 600.0,  # seconds to wait for a completion
+        connect_timeout: float = 10.0,
+        pool_size: int = 16,  # keep-alive connections held open
+    ):
+        self.ip_address = ip_address
+        self.port = port
+        self.timeout = (connect_timeout, timeout)
+        self._n_slots = n_slots
+        self._props: Dict[str, Any] = None
+        self._props_time = 0.0
+        self._slot_affinity: OrderedDict = OrderedDict()
+        self._next_slot = 0
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.ip_address}:{self.port}"
+
+    @property
+    def props(self) -> Dict[str, Any]:
+        # re-read after PROPS_TTL or a dropped connection: the server may have
+        # restarted with other weights
+        if self._props is None or time.monotonic() - self._props_time > PROPS_TTL:
+            # a loading server answers 503 with an error body: not its props
+            try:
+                response = self.session.get(f"{self.base_url}/props", timeout=self.timeout[0])
+                props = response.json() if response.ok else None
+            except (requests.RequestException, ValueError):
+                props = None
+            if props is None:
+                self._props = None
+                return {}
+            self._props, self._props_time = props, time.monotonic()
+        return self._props
+
+    def _post(self, path: str, data: Dict[str, Any], **kwargs) -> requests.Response:
+        try:
+            response = self.session.post(f"{self.base_url}{path}", data=json.dumps(data), **kwargs)
+        except requests.ConnectionError:
+            self._props = None
+            raise
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    @property
+    def n_slots(self) -> int:
+        # 1 until the server reports its slots; only a reported count is kept
+        if self._n_slots is None:
+            total_slots = self.props.get("total_slots")
+            if total_slots is None:
+                return 1
+            self._n_slots = int(total_slots)
+        return self._n_slots
+
+    @property
+    def model(self) -> str:
+        # identifies the loaded weights, e.g. for keying cached completions
+        props = self.props
+        model = props.get("model_path") or props.get(
+            "default_generation_settings", {}
+        ).get("model")
+        return model
+
+    @property
+    def n_ctx(self) -> int:
+        # context length of a single slot, if the server reports it
+        return self.props.get("default_generation_settings", {}).get("n_ctx")
+
+    def tokenize(self, text: str) -> List[int]:
+        return self._post("/tokenize", {"content": text}, timeout=self.timeout).json()["tokens"]
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """
+        Token counts of several texts from one /tokenize call. The texts are
+        joined by newlines and each returned piece is counted for the text its
+        last byte falls in; pieces of only newlines are separators.
+        """
+        if not texts:
+            return []
+        data = {"content": "\n".join(texts), "with_pieces": True}
+        tokens = self._post("/tokenize", data, timeout=self.timeout).json()["tokens"]
+        if tokens and not isinstance(tokens[0], dict):
+            raise ValueError("the server does not return token pieces")
+        ends, end = [], -1
+        for text in texts:
+            end += 1 + len(text.encode("utf-8"))
+            ends.append(end)  # byte offset of the newline after the text
+        counts = [0] * len(texts)
+        offset = 0
+        for token in tokens:
+            piece = token["piece"]
+            raw = piece.encode("utf-8") if isinstance(piece, str) else bytes(piece)
+            offset += len(raw)
+            if raw.strip(b"\n"):
+                counts[bisect.bisect_left(ends, offset - 1)] += 1
+        if offset != ends[-1]:
+            raise ValueError("token pieces do not add up to the texts")
+        return counts
+
+    def slot_for(self, slot_key: Hashable) -> int:
+        # requests sharing a key (e.g. a query) land on the same server slot,
+        # which keeps the KV cache of their common prompt prefix warm
+        if slot_key is None:
+            return None
+        with self._lock:
+            if slot_key in self._slot_affinity:
+                self._slot_affinity.move_to_end(slot_key)
+            else:
+                # round-robin, also once old keys are being evicted
+                self._slot_affinity[slot_key] = self._next_slot % self.n_slots
+                self._next_slot += 1
+                if len(self._slot_affinity) > MAX_SLOT_KEYS:
+                    self._slot_affinity.popitem(last=False)
+            return self._slot_affinity[slot_key]
+
+    def _with_slot(self, data: Dict[str, Any], slot_key: Hashable) -> Dict[str, Any]:
+        id_slot = self.slot_for(slot_key)
+        return data if id_slot is None else {**data, "id_slot": id_slot}
+
+    def health(self) -> bool:
+        # llama.cpp answers 503 while the model is loading
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=self.timeout[0])
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def _timeout(self, timeout: float = None) -> Tuple[float, float]:
+        if timeout is None:
+            return self.timeout
+        return (min(self.timeout[0], timeout), timeout)
+
+    def completion(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Dict[str, Any]:
+        data = self._with_slot(data, slot_key)
+        return self._post("/completion", data, timeout=self._timeout(timeout)).json()
+
+    def completion_stream(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Iterator[Dict[str, Any]]:
+        # server-sent events: one `data: {...}` line per generated chunk
+        data = {**self._with_slot(data, slot_key), "stream": True}
+        with self._post(
+            "/completion", data, timeout=self._timeout(timeout), stream=True
+        ) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                yield chunk
+                if chunk.get("stop"):
+                    break
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # semaphores are bound to the loop they are used in
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.n_slots)
+            return self._semaphores[loop]
+
+    async def completion_async(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Dict[str, Any]:
+        async with self._semaphore():
+            return await asyncio.to_thread(self.completion, data, slot_key, timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class LLMRouter:
+    """
+    Spreads requests over several llama.cpp servers (e.g. one `krirag-api`
+    container per host). Each request goes to the healthy endpoint with the
+    fewest in-flight requests, except that requests sharing a `slot_key`
+    stick to the endpoint they were first sent to, keeping its prefix cache
+    warm. Exposes the same interface as `LLMClient`.
+    """
+
+    def __init__(self, clients: List[LLMClient], health_interval: float = 30.0):
+        if not clients:
+            raise ValueError("LLMRouter needs at least one endpoint")
+        self.clients = clients
+        self.health_interval = health_interval
+        self._outstanding = {id(c): 0 for c in clients}
+        self._healthy = {id(c): True for c in clients}
+        self._affinity: OrderedDict = OrderedDict()
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return ",".join(c.base_url for c in self.clients)
+
+    def check_health(self) -> Dict[str, bool]:
+        for client in self.clients:
+            self._healthy[id(client)] = client.health()
+        self._last_check = time.monotonic()
+        return {c.base_url: self._healthy[id(c)] for c in self.clients}
+
+    def healthy_clients(self) -> List[LLMClient]:
+        if time.monotonic() - self._last_check > self.health_interval:
+            self.check_health()
+        healthy = [c for c in self.clients if self._healthy[id(c)]]
+        # if everything looks down, try anyway rather than failing outright
+        return healthy or self.clients
+
+    @property
+    def props(self) -> Dict[str, Any]:
+        return self.healthy_clients()[0].props
+
+    @property
+    def n_slots(self) -> int:
+        return sum(c.n_slots for c in self.healthy_clients())
+
+    @property
+    def model(self) -> str:
+        # endpoints are expected to serve the same model
+        return self.healthy_clients()[0].model
+
+    @property
+    def n_ctx(self) -> int:
+        n_ctx = [c.n_ctx for c in self.healthy_clients() if c.n_ctx]
+        return min(n_ctx) if n_ctx else None
+
+    def _acquire(self, slot_key: Hashable = None, exclude: LLMClient = None) -> LLMClient:
+        healthy = [c for c in self.healthy_clients() if c is not exclude]
+        if not healthy:
+            return None
+        with self._lock:
+            client = self._affinity.get(slot_key) if slot_key is not None else None
+            if client is None or client not in healthy:
+                client = min(healthy, key=lambda c: self._outstanding[id(c)] / c.n_slots)
+                if slot_key is not None:
+                    self._affinity[slot_key] = client
+                    if len(self._affinity) > MAX_SLOT_KEYS:
+                        self._affinity.popitem(last=False)
+            self._outstanding[id(client)] += 1
+            return client
+
+    def _release(self, client: LLMClient, failed: bool = False):
+        with self._lock:
+            self._outstanding[id(client)] -= 1
+            if failed:
+                self._healthy[id(client)] = False
+
+    def _call(self, method: str, *args, slot_key: Hashable = None, client: LLMClient = None):
+        client = client or self._acquire(slot_key)
+        failed = False
+        try:
+            return getattr(client, method)(*args)
+        except requests.ConnectionError:
+            failed = True
+            raise
+        finally:
+            self._release(client, failed)
+
+    def tokenize(self, text: str) -> List[int]:
+        return self._call("tokenize", text)
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        return self._call("count_tokens", texts)
+
+    def completion(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Dict[str, Any]:
+        return self._call("completion", data, slot_key, timeout, slot_key=slot_key)
+
+    def completion_hedged(
+        self,
+        data: Dict[str, Any],
+        slot_key: Hashable = None,
+        hedge_after: float = None,
+        timeout: float = None,
+    ) -> Tuple[Dict[str, Any], bool]:
+        """
+        Send the request to its usual endpoint, and if it has not answered
+        after `hedge_after` seconds, send a copy to a second endpoint. The
+        first response wins. Returns (response, whether a hedge was sent).
+        """
+        primary = self._acquire(slot_key)
+        futures = [
+            _hedge_pool().submit(
+                self._call, "completion", data, slot_key, timeout, client=primary
+            )
+        ]
+        done, _ = wait(futures, timeout=hedge_after)
+        hedged = False
+        if not done:
+            secondary = self._acquire(exclude=primary)
+            if secondary is not None:
+                hedged = True
+                futures.append(
+                    _hedge_pool().submit(
+                        self._call, "completion", data, None, timeout, client=secondary
+                    )
+                )
+        error = None
+        for future in as_completed(futures):
+            try:
+                return future.result(), hedged
+            except requests.RequestException as e:
+                error = e
+        raise error
+
+    def completion_stream(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Iterator[Dict[str, Any]]:
+        client = self._acquire(slot_key)
+        failed = False
+        try:
+            yield from client.completion_stream(data, slot_key, timeout)
+        except requests.ConnectionError:
+            failed = True
+            raise
+        finally:
+            self._release(client, failed)
+
+    async def completion_async(
+        self, data: Dict[str, Any], slot_key: Hashable = None, timeout: float = None
+    ) -> Dict[str, Any]:
+        # counted as outstanding while waiting for a slot on the endpoint
+        client = self._acquire(slot_key)
+        failed = False
+        try:
+            return await client.completion_async(data, slot_key, timeout)
+        except requests.ConnectionError:
+            failed = True
+            raise
+        finally:
+            self._release(client, failed)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+
+_clients: Dict[Tuple[str, int], LLMClient] = {}
+_routers: Dict[Tuple[Tuple[str, int], ...], LLMRouter] = {}
+_clients_lock = threading.Lock()
+
+
+def parse_endpoints(ip_address: str, port: int) -> List[Tuple[str, int]]:
+    # "host-a, host-b:8503" -> [("host-a", port), ("host-b", 8503)]
+    endpoints = []
+    for endpoint in ip_address.split(","):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        host, _, endpoint_port = endpoint.partition(":")
+        endpoints.append((host, int(endpoint_port or port)))
+    if not endpoints:
+        raise ValueError(f"No LLM endpoint in {ip_address!r}")
+    return endpoints
+
+
+def get_llm_client(ip_address: str, port: int) -> Union[LLMClient, LLMRouter]:
+    """
+    One pooled client per server, shared by all callers in the process.
+    A comma-separated `ip_address` gives a router over all listed servers.
+    """
+    endpoints = parse_endpoints(ip_address, port)
+    with _clients_lock:
+        for key in endpoints:
+            if key not in _clients:
+                _clients[key] = LLMClient(*key)
+        if len(endpoints) == 1:
+            return _clients[endpoints[0]]
+        key = tuple(endpoints)
+        if key not in _routers:
+            _routers[key] = LLMRouter([_clients[e] for e in endpoints])
+        return _routers[key]
+
+
+class CompletionCache:
+    """
+    On-disk (SQLite) cache of deterministic completions with LRU eviction.
+
+    Entries are keyed by a hash of the request payload (prompt, schema and
+    sampling parameters) and the model identity reported by the server.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS completions_lru ON completions (last_used)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def make_key(data: Dict[str, Any], use_schema: str, model: str) -> str:
+        # slot/transport options do not change the output
+        keyed = {k: v for k, v in data.items() if k not in _UNCACHED_KEYS}
+        keyed["schema_name"] = use_schema
+        keyed["model"] = model
+        raw = json.dumps(keyed, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._db.commit()
+            return row[0]
+
+    def put(self, key: str, content: str):
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, content, size, time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop least recently used entries until we fit again
+        for key, size in self._db.execute(
+            "SELECT key, size FROM completions ORDER BY last_used ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+            self._db.commit()
+
+
+_completion_cache: CompletionCache = None
+
+
+def get_completion_cache() -> CompletionCache:
+    # LLM_CACHE_PATH="" disables the cache
+    global _completion_cache
+    path = os.environ.get("LLM_CACHE_PATH", LLM_CACHE_PATH)
+    if not path:
+        return None
+    with _clients_lock:
+        if _completion_cache is None or _completion_cache.path != path:
+            max_mb = int(os.environ.get("LLM_CACHE_MAX_MB", LLM_CACHE_MAX_MB))
+            _completion_cache = CompletionCache(path, max_bytes=max_mb * 1024 * 1024)
+        return _completion_cache
+
+
+def _cache_lookup(
+    client: Union[LLMClient, LLMRouter], data: Dict[str, Any], use_schema: str, use_cache: bool
+) -> Tuple[CompletionCache, str, str]:
+    # only deterministic (greedy) completions are safe to replay
+    cache = get_completion_cache() if use_cache and data["temperature"] == 0 else None
+    model = client.model if cache is not None else None
+    if model is None:
+        return None, None, None
+    key = cache.make_key(data, use_schema, model)
+    return cache, key, cache.get(key)
+
+
+class LLMTimeoutError(TimeoutError):
+    """An LLM call did not finish within its deadline (including retries)."""
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies, used to decide when to hedge."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: Dict[Hashable, deque] = defaultdict(
+            lambda: deque(maxlen=self.window)
+        )
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable, seconds: float):
+        with self._lock:
+            self._latencies[key].append(seconds)
+
+    def percentile(self, key: Hashable, q: float = 0.95) -> float:
+        with self._lock:
+            samples = sorted(self._latencies[key])
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+# latencies per n_predict, as long generations are expected to be slow
+latencies = LatencyTracker()
+_hedge_executor: ThreadPoolExecutor = None
+
+
+def _hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _clients_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=32)
+        return _hedge_executor
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, asyncio.TimeoutError)):
+        return True
+    # e.g. 503 while the model is loading
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code >= 500
+
+
+def _backoff(attempt: int, remaining: float = None) -> float:
+    delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+    delay += random.uniform(0, RETRY_BACKOFF)
+    return delay if remaining is None else max(min(delay, remaining), 0.0)
+
+
+def _remaining(start: float, deadline: float) -> float:
+    if deadline is None:
+        return None
+    remaining = deadline - (time.monotonic() - start)
+    if remaining <= 0:
+        raise LLMTimeoutError(f"LLM call exceeded its deadline of {deadline}s")
+    return remaining
+
+
+def _give_up(error: Exception, attempt: int, retries: int, start: float, deadline: float):
+    # re-raises unless the error is worth another attempt
+    if not _is_retryable(error) or attempt > retries:
+        if isinstance(error, (requests.Timeout, asyncio.TimeoutError)):
+            raise LLMTimeoutError(f"LLM call timed out after {attempt} attempt(s)") from error
+        raise error
+    print(f"LLM call failed ({error!r}), retry {attempt}/{retries}")
+    return _backoff(attempt, _remaining(start, deadline))
+
+
+def _complete_with_policy(
+    client: Union[LLMClient, LLMRouter],
+    data: Dict[str, Any],
+    slot_key: Hashable,
+    deadline: float,
+    retries: int,
+    hedge: bool,
+    metrics: Dict[str, Any],
+) -> Dict[str, Any]:
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = _remaining(start, deadline)
+        attempt_start = time.monotonic()
+        hedge_after = latencies.percentile(data["n_predict"]) if hedge else None
+        try:
+            if hedge_after is not None and isinstance(client, LLMRouter):
+                response, hedged = client.completion_hedged(
+                    data, slot_key, hedge_after, timeout=remaining
+                )
+                metrics["hedged"] = metrics.get("hedged", False) or hedged
+            else:
+                response = client.completion(data, slot_key, timeout=remaining)
+            break
+        except requests.RequestException as e:
+            time.sleep(_give_up(e, attempt, retries, start, deadline))
+
+    latencies.record(data["n_predict"], time.monotonic() - attempt_start)
+    metrics.update({"latency_s": time.monotonic() - start, "attempts": attempt})
+    return response
+
+
+async def _complete_with_policy_async(
+    client: Union[LLMClient, LLMRouter],
+    data: Dict[str, Any],
+    slot_key: Hashable,
+    deadline: float,
+    retries: int,
+    hedge: bool,
+    metrics: Dict[str, Any],
+) -> Dict[str, Any]:
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = _remaining(start, deadline)
+        attempt_start = time.monotonic()
+        hedge_after = latencies.percentile(data["n_predict"]) if hedge else None
+        try:
+            if hedge_after is not None and isinstance(client, LLMRouter):
+                response, hedged = await asyncio.to_thread(
+                    client.completion_hedged, data, slot_key, hedge_after, remaining
+                )
+                metrics["hedged"] = metrics.get("hedged", False) or hedged
+            else:
+                # the deadline also covers waiting for a free slot
+                response = await asyncio.wait_for(
+                    client.completion_async(data, slot_key, timeout=remaining),
+                    timeout=remaining,
+                )
+            break
+        except (requests.RequestException, asyncio.TimeoutError) as e:
+            await asyncio.sleep(_give_up(e, attempt, retries, start, deadline))
+
+    latencies.record(data["n_predict"], time.monotonic() - attempt_start)
+    metrics.update({"latency_s": time.monotonic() - start, "attempts": attempt})
+    return response
+
+
+def _completion_payload(
+    instruction: str,
+    max_tokens: int,
+    use_schema: str,
+    temp: float,
+) -> Dict[str, Any]:
+    if len(instruction) == 0:
+        raise ValueError("Instruction cannot be empty")
+
+    data = {
+        "prompt": instruction,
+        "n_predict": max_tokens,
+        "temperature": temp,
+        "repeat_penalty": 1.2,  # 1.1 default,
+        "cache_prompt": True,  # only prefill the part of the prompt not in the slot's KV cache
+    }
+    if use_schema:
+        data["json_schema"] = schemas[use_schema]
+    return data
+
+
 def pred(
     instruction,
     ip_address: str,
@@ -86,51 +813,409 @@ def pred(
     # top_p=0.9,  # nucleus sampling
     # top_k=40,  # consider top k tokens at each generation step
     evaluate: bool = False,  # apply eval
+    use_cache: bool = True,  # reuse deterministic completions (temp=0)
+    slot_key: Hashable = None,  # pin calls with the same key to one server slot
+    deadline: float = None,  # seconds for the whole call, retries included
+    retries: int = DEFAULT_RETRIES,  # on timeouts, connection and server errors
+    hedge: bool = False,  # duplicate to a second server when slower than p95
+    metrics: Dict[str, Any] = None,  # filled with latency_s/attempts/hedged/cached
 ):
-    url = f"http://{ip_address}:{port}/completion"  # llama.cpp server
-    if len(instruction) == 0:
-        raise ValueError("Instruction cannot be empty")
+    metrics = {} if metrics is None else metrics
+    client = get_llm_client(ip_address, port)
+    data = _completion_payload(instruction, max_tokens, use_schema, temp)
+    cache, key, response = _cache_lookup(client, data, use_schema, use_cache)
+    metrics.update({"cached": response is not None, "attempts": 0, "hedged": False})
+    if response is None:
+        response = _complete_with_policy(
+            client, data, slot_key, deadline, retries, hedge, metrics
+        )["content"]
+        if cache is not None:
+            cache.put(key, response)
+    if evaluate:
+        return parse_llm_output(response, use_schema=use_schema)
+    return response
 
-    data = {
-        "prompt": instruction,
-        "n_predict": max_tokens,
-        "temperature": temp,
-        "repeat_penalty": 1.2,  # 1.1 default,
-    }
-    if use_schema:
-        data["json_schema"] = schemas[use_schema]
 
-    response = requests.post(url, headers=headers, data=json.dumps(data)).json()
-    response = response["content"]
+async def pred_async(
+    instruction,
+    ip_address: str,
+    port: int,
+    max_tokens=1000,
+    use_schema: str = "default",
+    temp=0.0,
+    evaluate: bool = False,
+    use_cache: bool = True,
+    slot_key: Hashable = None,
+    deadline: float = None,
+    retries: int = DEFAULT_RETRIES,
+    hedge: bool = False,
+    metrics: Dict[str, Any] = None,
+):
+    # same as `pred`, but waits for a free server slot without blocking the caller
+    metrics = {} if metrics is None else metrics
+    client = get_llm_client(ip_address, port)
+    data = _completion_payload(instruction, max_tokens, use_schema, temp)
+    cache, key, response = _cache_lookup(client, data, use_schema, use_cache)
+    metrics.update({"cached": response is not None, "attempts": 0, "hedged": False})
+    if response is None:
+        response = (
+            await _complete_with_policy_async(
+                client, data, slot_key, deadline, retries, hedge, metrics
+            )
+        )["content"]
+        if cache is not None:
+            cache.put(key, response)
     if evaluate:
-        return parse_llm_output(response)
+        return parse_llm_output(response, use_schema=use_schema)
     return response
 
 
-def parse_llm_output(response: str):
+class IncrementalJSONParser:
+    """
+    Incremental parser for the top-level fields of a streamed JSON object.
+
+    `feed` returns the (key, value) pairs completed by the new text, so e.g.
+    `score` and `questions` are available before `summary` is done.
+    `partial` exposes the string field currently being generated.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_role = None  # "key" or "value" for top-level strings
+        self._expect = "key"
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        self.buffer += text
+        completed = []
+        buf = self.buffer
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._string_role == "key":
+                        self._key = json.loads(buf[self._key_start : i + 1])
+                        self._expect = "colon"
+                    self._string_role = None
+                continue
+
+            if self._depth == 1 and self._expect == "value" and self._value_start is None:
+                if not c.isspace():
+                    self._value_start = i
+            if self._depth == 1 and c in ",}" and self._value_start is not None:
+                field = self._complete(buf[self._value_start : i])
+                if field is not None:
+                    completed.append(field)
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect == "key":
+                    self._string_role = "key"
+                    self._key_start = i
+                elif self._depth == 1 and self._expect == "value":
+                    self._string_role = "value"
+            elif c == ":" and self._depth == 1 and self._expect == "colon":
+                self._expect = "value"
+                self._value_start = None
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+        self._pos = len(buf)
+        return completed
+
+    def _complete(self, raw: str) -> Tuple[str, Any]:
+        key = self._key
+        self._expect = "key"
+        self._key = None
+        self._value_start = None
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return None
+        self.fields[key] = value
+        return key, value
+
+    def partial(self) -> Tuple[str, str]:
+        # the top-level string value being generated right now, if any
+        if not (self._in_string and self._string_role == "value"):
+            return None
+        raw = self.buffer[self._value_start + 1 :]
+        if raw.endswith("\\") and not raw.endswith("\\\\"):
+            raw = raw[:-1]
+        try:
+            return self._key, json.loads(f'"{raw}"')
+        except ValueError:
+            return self._key, raw
+
+
+def pred_stream(
+    instruction,
+    ip_address: str,
+    port: int,
+    max_tokens=1000,
+    use_schema: str = "default",
+    temp=0.0,
+    use_cache: bool = True,
+    slot_key: Hashable = None,
+    deadline: float = None,
+    retries: int = DEFAULT_RETRIES,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of `pred`. Yields events as the completion is generated:
+      {"event": "field", "key": ..., "value": ...}    a top-level field is complete
+      {"event": "partial", "key": ..., "value": ...}  text of the open string field
+      {"event": "done", "content": ..., "metrics": {...}}
+    Metrics hold time-to-first-token (ttft_s), total_s, n_tokens, tokens_per_s
+    and attempts. Failed calls are only retried before the first token.
+    """
+    client = get_llm_client(ip_address, port)
+    data = _completion_payload(instruction, max_tokens, use_schema, temp)
+    parser = IncrementalJSONParser()
+    start = time.perf_counter()
+
+    cache, key, content = _cache_lookup(client, data, use_schema, use_cache)
+    if content is not None:
+        for field_key, value in parser.feed(content):
+            yield {"event": "field", "key": field_key, "value": value}
+        total = time.perf_counter() - start
+        metrics = {"cached": True, "ttft_s": total, "total_s": total}
+        yield {"event": "done", "content": content, "metrics": metrics}
+        return
+
+    first_token_at = None
+    n_tokens = 0
+    timings = {}
+    pieces = []
+    deadline_start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = _remaining(deadline_start, deadline)
+        try:
+            for chunk in client.completion_stream(data, slot_key, timeout=remaining):
+                piece = chunk.get("content", "")
+                if piece:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    n_tokens += 1
+                    pieces.append(piece)
+                    for field_key, value in parser.feed(piece):
+                        yield {"event": "field", "key": field_key, "value": value}
+                    partial = parser.partial()
+                    if partial is not None:
+                        yield {"event": "partial", "key": partial[0], "value": partial[1]}
+                if chunk.get("stop"):
+                    timings = chunk.get("timings", {})
+                _remaining(deadline_start, deadline)
+            break
+        except requests.RequestException as e:
+            if pieces:
+                # partial output has been emitted, a retry would repeat it
+                if isinstance(e, requests.Timeout):
+                    raise LLMTimeoutError("LLM stream stalled") from e
+                raise
+            time.sleep(_give_up(e, attempt, retries, deadline_start, deadline))
+
+    end = time.perf_counter()
+    content = "".join(pieces)
+    if cache is not None:
+        cache.put(key, content)
+
+    first_token_at = first_token_at or end
+    n_tokens = timings.get("predicted_n", n_tokens)
+    gen_time = end - first_token_at
+    metrics = {
+        "cached": False,
+        "ttft_s": first_token_at - start,
+        "total_s": end - start,
+        "n_tokens": n_tokens,
+        "tokens_per_s": timings.get(
+            "predicted_per_second", n_tokens / gen_time if gen_time > 0 else 0.0
+        ),
+        "attempts": attempt,
+    }
+    yield {"event": "done", "content": content, "metrics": metrics}
+
+
+class LLMOutputError(ValueError):
+    """Model output that cannot be parsed into, or validated as, the expected JSON."""
+
+
+def parse_llm_output(response: str, use_schema: str = None):
+    """
+    Parse (and optionally validate) JSON produced by the LLM.
+
+    Well-formed JSON takes the fast path. Otherwise a bounded repair pass
+    handles markdown fences, surrounding chatter, trailing commas, python
+    literals and output truncated by `n_predict`. Raises `LLMOutputError`.
+    """
     if not response:
         return response
-    # spacing!
-    response = response.replace("\n", " ")
-    response = response.replace("\t", " ")
-    response = re.sub(r"\s+", " ", response)
-    response = response.strip()
-    # markdown ticks
-    response = response.replace("```python", "")
-    response = response.replace("```json", "")
-    response = response.replace("```", "")
-
-    response = response.replace("false", "False")
-    response = response.replace("true", "True")
-    response = response.replace("null", "None")
-
-    obj = eval(response)
+    try:
+        obj = json.loads(response)
+    except ValueError:
+        obj = _repair_llm_output(response)
     if isinstance(obj, dict):
         # unify keys in case of capitalization.
         obj = {k.lower(): v for k, v in obj.items()}
+    if use_schema:
+        obj = validate_llm_output(obj, schemas[use_schema])
     return obj
 
 
+def _repair_llm_output(response: str):
+    text = re.sub(r"```(?:json|python)?", "", response).strip()
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise LLMOutputError("No JSON object found in LLM output")
+    text = re.sub(r",\s*([}\]])", r"\1", text[start:])
+
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+    try:
+        # python-style output: single quotes, True/False/None
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    for candidate in _truncation_candidates(text):
+        try:
+            return json.loads(candidate, strict=False)
+        except ValueError:
+            continue
+    raise LLMOutputError(f"Could not repair LLM output: {response[:80]!r}...")
+
+
+def _truncation_candidates(text: str) -> Iterator[str]:
+    # walk the text once, tracking open strings and brackets
+    stack = []
+    in_string = False
+    escape = False
+    commas = []  # (position, closing brackets needed) of member separators
+    for i, c in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if not stack:
+                return
+            stack.pop()
+            if not stack:
+                # a complete value followed by chatter
+                yield text[: i + 1]
+                return
+        elif c == ",":
+            commas.append((i, "".join(reversed(stack))))
+
+    if not stack:
+        return
+    # output cut off by n_predict: close what is open...
+    closed = text.rstrip("\\") + '"' if in_string else text.rstrip()
+    yield closed.rstrip(",:") + "".join(reversed(stack))
+    # ...or drop the last (incomplete) members
+    for pos, closers in reversed(commas[-MAX_REPAIR_ATTEMPTS:]):
+        yield text[:pos] + closers
+
+
+def validate_llm_output(obj: Any, schema: Dict[str, Any], path: str = "$") -> Any:
+    """
+    Check `obj` against the (subset of) JSON schema used in `schemas`.
+    Coerces harmless deviations (numeric strings, too many items).
+    """
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(obj, dict):
+            raise LLMOutputError(f"{path}: expected object, got {type(obj).__name__}")
+        obj = {str(k).lower(): v for k, v in obj.items()}
+        missing = [k for k in schema.get("required", []) if k not in obj]
+        if missing:
+            raise LLMOutputError(f"{path}: missing keys {missing}")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in obj:
+                obj[key] = validate_llm_output(obj[key], sub_schema, f"{path}.{key}")
+    elif expected == "array":
+        if not isinstance(obj, list):
+            raise LLMOutputError(f"{path}: expected array, got {type(obj).__name__}")
+        if len(obj) < schema.get("minItems", 0):
+            raise LLMOutputError(f"{path}: expected at least {schema['minItems']} items")
+        obj = obj[: schema.get("maxItems", len(obj))]
+        if "items" in schema:
+            obj = [
+                validate_llm_output(item, schema["items"], f"{path}[{i}]")
+                for i, item in enumerate(obj)
+            ]
+    elif expected == "integer":
+        if isinstance(obj, str) and obj.strip().lstrip("-").isdigit():
+            obj = int(obj)
+        elif isinstance(obj, float) and obj.is_integer():
+            obj = int(obj)
+        if not isinstance(obj, int) or isinstance(obj, bool):
+            raise LLMOutputError(f"{path}: expected integer, got {obj!r}")
+    elif expected == "string":
+        if not isinstance(obj, str):
+            raise LLMOutputError(f"{path}: expected string, got {type(obj).__name__}")
+
+    if "enum" in schema and obj not in schema["enum"]:
+        raise LLMOutputError(f"{path}: {obj!r} not in {schema['enum']}")
+    return obj
+
+
+def _ask_llm_instruction(
+    query: str,
+    text: str,
+    extra: str,
+    doc_id: str,
+    prompt_source: dict,
+    lang: str,
+) -> str:
+    text = re.sub(r"\.{3,}", "...", text)
+
+    if extra:
+        extra = memory_wrapper.format(extra=extra)
+
+    return prompt_source[lang].format(
+        query=query,
+        text=text,
+        extra=extra,
+        doc_id=doc_id,
+    )
+
+
+def _parse_ask_llm_output(output: str, verbose: bool = False):
+    if verbose:
+        print("-*-" * 40)
+        print(output)
+        print("-*-" * 40)
+    try:
+        output = parse_llm_output(output, use_schema="default")
+    except LLMOutputError as e:
+        print(f"Invalid LLM output ({e}). Returning raw output")
+    return output
+
+
 def ask_llm(
     query: str,
     text: str,
@@ -143,35 +1228,158 @@ def ask_llm(
     prompt_source: dict = None,  # see "question_and_reason_prompt" above.
     lang: str = "en",
     verbose: bool = False,
+    deadline: float = None,  # see `pred`
+    retries: int = DEFAULT_RETRIES,
+    hedge: bool = False,
+    metrics: Dict[str, Any] = None,
 ) -> dict:
-    text = re.sub(r"\.{3,}", "...", text)
-
-    if extra:
-        extra = f"You have info from previous interrogations: '{extra}'. Use this info to guide your reasoning if relevant."
+    instruction = _ask_llm_instruction(query, text, extra, doc_id, prompt_source, lang)
+    if verbose:
+        print("Instruction", instruction)
 
-    instruction = prompt_source[lang].format(
-        query=query,
-        text=text,
-        extra=extra,
-        doc_id=doc_id,
+    output = pred(
+        instruction=instruction,
+        ip_address=ip_address,
+        port=port,
+        temp=temp,
+        max_tokens=tokens,
+        use_schema="default",
+        slot_key=query,
+        deadline=deadline,
+        retries=retries,
+        hedge=hedge,
+        metrics=metrics,
     )
+    return _parse_ask_llm_output(output, verbose=verbose)
+
+
+async def ask_llm_async(
+    query: str,
+    text: str,
+    ip_address: str,
+    port: int,
+    extra: str = "",
+    doc_id: str = "ID",
+    temp: float = 0.0,
+    tokens: int = 150,
+    prompt_source: dict = None,
+    lang: str = "en",
+    verbose: bool = False,
+    deadline: float = None,  # see `pred`
+    retries: int = DEFAULT_RETRIES,
+    hedge: bool = False,
+    metrics: Dict[str, Any] = None,
+) -> dict:
+    instruction = _ask_llm_instruction(query, text, extra, doc_id, prompt_source, lang)
     if verbose:
         print("Instruction", instruction)
 
-    output = pred(
+    output = await pred_async(
         instruction=instruction,
         ip_address=ip_address,
         port=port,
         temp=temp,
         max_tokens=tokens,
         use_schema="default",
+        slot_key=query,
+        deadline=deadline,
+        retries=retries,
+        hedge=hedge,
+        metrics=metrics,
     )
+    return _parse_ask_llm_output(output, verbose=verbose)
+
+
+def ask_llm_stream(
+    query: str,
+    text: str,
+    ip_address: str,
+    port: int,
+    extra: str = "",
+    doc_id: str = "ID",
+    temp: float = 0.0,
+    tokens: int = 150,
+    prompt_source: dict = None,
+    lang: str = "en",
+    verbose: bool = False,
+    deadline: float = None,
+    retries: int = DEFAULT_RETRIES,
+) -> Iterator[Dict[str, Any]]:
+    # events from `pred_stream`; the final "done" event also carries the parsed "output"
+    instruction = _ask_llm_instruction(query, text, extra, doc_id, prompt_source, lang)
     if verbose:
-        print("-*-" * 40)
-        print(output)
-        print("-*-" * 40)
-    try:
-        output = parse_llm_output(output)
-    except SyntaxError as e:
-        print("SyntaxError. Returning raw output")
-    return output
+        print("Instruction", instruction)
+
+    for event in pred_stream(
+        instruction=instruction,
+        ip_address=ip_address,
+        port=port,
+        temp=temp,
+        max_tokens=tokens,
+        use_schema="default",
+        slot_key=query,
+        deadline=deadline,
+        retries=retries,
+    ):
+        if event["event"] == "done":
+            event["output"] = _parse_ask_llm_output(event["content"], verbose=verbose)
+        yield event
+
+
+def triage_llm(
+    query: str,
+    text: str,
+    ip_address: str,
+    port: int,
+    doc_id: str = "ID",
+    prompt_source: dict = None,
+    lang: str = "en",
+    deadline: float = None,
+    retries: int = DEFAULT_RETRIES,
+    metrics: Dict[str, Any] = None,
+) -> Dict[str, Any]:
+    """
+    Cheap relevance check before a full `ask_llm` generation: a single
+    grammar-constrained token (0-3) with its top probabilities.
+    Returns {"score": int, "probs": {score: probability}}.
+    """
+    metrics = {} if metrics is None else metrics
+    instruction = _ask_llm_instruction(query, text, "", doc_id, prompt_source, lang)
+    instruction += triage_suffix[lang].format(doc_id=doc_id)
+    data = _completion_payload(instruction, max_tokens=1, use_schema=None, temp=0.0)
+    # post-sampling: probabilities after the [0-3] grammar, as "top_probs"/"prob"
+    data.update({"grammar": "root ::= [0-3]", "n_probs": 4, "post_sampling_probs": True})
+
+    client = get_llm_client(ip_address, port)
+    response = _complete_with_policy(
+        client, data, query, deadline, retries, False, metrics
+    )
+    probs = _score_probs(response)
+    content = response["content"].strip()
+    if content in ("0", "1", "2", "3"):
+        score = int(content)
+    elif probs:
+        score = max(probs, key=probs.get)
+    else:
+        # e.g. the server ignored the grammar: when in doubt, analyze the text
+        print(f"Unparsable triage output {content!r}. Treating the text as relevant")
+        score = 3
+    return {"score": score, "probs": probs}
+
+
+def _score_probs(response: Dict[str, Any]) -> Dict[int, float]:
+    # llama.cpp has returned "probs"/"tok_str"; current servers return
+    # "top_logprobs"/"logprob", or "top_probs"/"prob" with post_sampling_probs
+    probs: Dict[int, float] = {}
+    for position in response.get("completion_probabilities", [])[:1]:
+        candidates = position.get("top_probs") or position.get("probs")
+        if candidates is None:
+            candidates = [
+                {**c, "prob": math.exp(c["logprob"])} for c in position.get("top_logprobs", [])
+            ]
+        for candidate in candidates:
+            token = str(candidate.get("token", candidate.get("tok_str", ""))).strip()
+            if token in ("0", "1", "2", "3"):
+                probs[int(token)] = probs.get(int(token), 0.0) + candidate.get("prob", 0.0)
+    total = sum(probs.values())
+    return {k: v / total for k, v in probs.items()} if total > 0 else probs
@@ -10,181 +10,491 @@
 # ------------------------------------------------------------------------------
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from functools import partial
+from typing import Any, Dict, Hashable, List, Tuple
 
 import jsonlines
+import requests
 import streamlit as st
-from chromadb.types import Collection
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from llm import (
+    LLMOutputError,
+    LLMTimeoutError,
     ask_llm,
+    ask_llm_stream,
+    get_completion_cache,
+    get_llm_client,
     memory_prompt,
+    memory_wrapper,
     parse_llm_output,
     pred,
     question_and_reason_prompt,
+    triage_llm,
 )
-from utils.batch import get_sentence_batches
-from utils.chroma import get_matching_documents
+from utils.batch import TokenCounter, get_token_budget
+from utils.bm25 import get_bm25_index
+from utils.catalog import get_catalog
+from utils.chroma import (
+    AGGREGATIONS,
+    DocumentCache,
+    get_matching_documents,
+    get_ranked_documents,
+    get_ranked_documents_batch,
+)
+from utils.memory import QueryMemory
+from utils.vectorstore import VectorStore
 
 
-def run_rag(
-    queries: List[str],
-    collection: Collection,
+MEMORY_TOKENS: int = 1000  # max length of the summarised query memory
+BUDGET_STEP: int = 64  # granularity of batch token budgets
+
+
+def _passes_triage(result: Dict[str, Any], min_score: int, min_prob: float = None) -> bool:
+    if result["score"] >= min_score:
+        return True
+    if min_prob is None or not result["probs"]:
+        return False
+    p_relevant = sum(p for score, p in result["probs"].items() if score >= min_score)
+    return p_relevant >= min_prob
+
+
+def _compact_memory(
+    entries: List[str],
+    doc_id: str,
+    query: str,
     ip_address: str,
     port: int,
-    lang: str = "en",
-    top_n: int = 10,
-    llm_ctx_len: int = 8168,
-    new_tokens: int = 2048,
+    deadline: float = None,
+    hedge: bool = False,
+    slot_key: Hashable = None,
 ) -> str:
-    # print all locals that rag is running with:
-    print(locals())
+    memory_metrics: Dict[str, Any] = {}
+    summary = pred(
+        instruction=memory_prompt.format(
+            previous_information=entries,
+            query=query,
+            DOC_ID=doc_id,
+        ),
+        ip_address=ip_address,
+        port=port,
+        max_tokens=MEMORY_TOKENS,
+        use_schema="summary",
+        slot_key=slot_key,
+        deadline=deadline,
+        hedge=hedge,
+        metrics=memory_metrics,
+    )
+    print(f"Memory summary metrics: {memory_metrics}")
+    try:
+        summary = parse_llm_output(summary, use_schema="summary")["summary"]
+    except LLMOutputError as e:
+        print(f"Invalid memory summary ({e}). Using raw output")
+    print(f"Identified previous information: {summary}")
+    return summary
 
-    start_of_program: str = datetime.now().strftime("%Y%m%d-%H%M%S")
-    _metadata: List[dict] = collection.get()["metadatas"]
-    _documents: set = set([d["document"] for d in _metadata])
-    if top_n == -1:
-        top_n = len(_documents)
 
-    case_folder = f"RAG_Top{top_n}_{start_of_program}"
-    rag_path = os.path.join("output", case_folder)
+def _stream_llm_output(matched_doc: str, **ask_kwargs) -> Tuple[Any, Dict[str, Any]]:
+    # show fields as soon as they are complete, and the summary as it is written
+    placeholder = st.empty()
+    fields: Dict[str, Any] = {}
+    summary: str = ""
+    llm_output, metrics = None, {}
+    last_render = 0.0
+    for event in ask_llm_stream(**ask_kwargs):
+        if event["event"] == "field":
+            fields[event["key"]] = event["value"]
+            if event["key"] == "summary":
+                summary = event["value"]
+        elif event["event"] == "partial" and event["key"] == "summary":
+            summary = event["value"]
+            # avoid flooding the websocket with one redraw per token
+            if time.perf_counter() - last_render < 0.25:
+                continue
+        elif event["event"] == "done":
+            llm_output, metrics = event["output"], event["metrics"]
+            break
+        else:
+            continue
 
-    for query in queries:
-        st.write(f"Processing query: {query}")
-        print(f"Query: {query}")
+        last_render = time.perf_counter()
+        with placeholder.container():
+            score = fields.get("score", "...")
+            st.markdown(f"**{matched_doc}** (relevance score: {score}/3) - generating...")
+            for q in fields.get("questions", []):
+                if isinstance(q, dict) and "question" in q:
+                    st.markdown(f"- {q['question']}")
+            if summary:
+                st.caption(summary)
+    placeholder.empty()
+    return llm_output, metrics
+
+
+def _run_query(
+    query: str,
+    query_index: int,
+    collection: VectorStore,
+    doc_cache: DocumentCache,
+    rag_path: str,
+    ip_address: str,
+    port: int,
+    lang: str,
+    top_n: int,
+    retrieval: str,
+    rankings: Dict[str, List[Dict[str, Any]]],
+    llm_ctx_len: int,
+    new_tokens: int,
+    count_tokens: TokenCounter,
+    stream: bool,
+    deadline: float,
+    hedge: bool,
+    triage: bool,
+    triage_min_score: int,
+    triage_min_prob: float,
+    memory_policy: str,
+    memory_every_n: int,
+    memory_background: bool,
+) -> str:
+    # analyse the matching documents for one query, with its own memory and output file
+    st.write(f"Processing query: {query}")
+    print(f"Query: {query}")
+    hits: Dict[str, Dict[str, Any]] = {}
+    if retrieval == "sentences":
         documents = get_matching_documents(
             collection=collection,
             query=query,
             n_results=top_n,
         )
         print(f"Reduced from {top_n} to {len(documents)} documents")
+    else:
+        # most relevant documents first, so they get the llm first
+        ranked = rankings.get(query)
+        if ranked is None:
+            ranked = get_ranked_documents(
+                collection=collection,
+                query=query,
+                top_n=top_n,
+                aggregation=retrieval,
+            )
+        ranked = [dict(r) for r in ranked]
+        documents = [r["document"] for r in ranked]
+        hits = {r.pop("document"): r for r in ranked}
+        print(f"Top {len(documents)} documents ({retrieval}): {documents}")
+    # fetch the text of all matched documents in one go
+    doc_cache.prefetch(documents)
 
-        # 1 word can easily span 3-4 tokens
-        # thus, to match the context length: ctx_len//4
-        TOKEN_LEN: int = llm_ctx_len // 4
+    timestamp: str = datetime.now().strftime("%Y%m%d-%H%M%S")
+    filename: str = re.sub(r"[^\w\s]", "", query)
+    filename = filename.replace(" ", "-")
 
-        timestamp: str = datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename: str = re.sub(r"[^\w\s]", "", query)
-        filename = filename.replace(" ", "-")
+    # the index keeps queries differing only in punctuation apart (and in order)
+    output_path = os.path.join(rag_path, f"{timestamp}_{query_index:03d}_{filename}.jsonl")
+    os.makedirs(rag_path, exist_ok=True)
 
-        output_path = os.path.join(rag_path, f"{timestamp}_{filename}.jsonl")
-        os.makedirs(os.path.join("output", case_folder), exist_ok=True)
+    # hold the "summary" field across documents to feed to the LLM
+    QUERY_MEMORY: List[str] = []
+    memory = QueryMemory(
+        compact=partial(
+            _compact_memory,
+            query=query,
+            ip_address=ip_address,
+            port=port,
+            deadline=deadline,
+            hedge=hedge,
+            # in line, memory calls share the query's slot and run before
+            # triage, so triage and ask_llm prefill the text back to back;
+            # in the background, pinning them would queue behind those calls
+            slot_key=None if memory_background else query,
+        ),
+        policy=memory_policy,
+        every_n=memory_every_n,
+        max_tokens=MEMORY_TOKENS,
+        count_tokens=count_tokens,
+        background=memory_background,
+    )
+    n_batches: int = 0
+    n_triaged: int = 0
 
-        # hold the "summary" field across documents to feed to the LLM
-        QUERY_MEMORY: List[str] = []
+    with jsonlines.open(output_path, "w") as writer:
+        progress_text = f"Processing {len(documents)} documents..."
+        progress_bar = st.progress(0, text=progress_text)
 
-        with jsonlines.open(output_path, "w") as writer:
-            progress_text = f"Processing {len(documents)} documents..."
-            progress_bar = st.progress(0, text=progress_text)
+        for i, matched_doc in enumerate(documents):
+            current_percentage = (i + 1) / len(documents)
+            progress_bar.progress(
+                current_percentage, text=f"Document {i + 1}/{len(documents)}"
+            )
+            texts: List[str] = doc_cache.sentences(matched_doc)
+            print(f"Doc {matched_doc} has {len(texts)} sentences")
 
-            for i, matched_doc in enumerate(documents):
-                current_percentage = (i + 1) / len(documents)
-                progress_bar.progress(
-                    current_percentage, text=f"Document {i + 1}/{len(documents)}"
-                )
-                matching_full_docs = collection.get(
-                    where={"document": {"$in": [matched_doc]}},
+            DOC_ID: str = matched_doc
+            print(f"Doc ID: {DOC_ID}")
+
+            # - some documents are LONG, batch them into smaller chunks
+            # that fit the context next to the prompt, memory and output
+            prompt_tokens = count_tokens(
+                question_and_reason_prompt[lang].format(
+                    query=query,
+                    text="",
+                    extra=memory_wrapper.format(extra=""),
+                    doc_id=DOC_ID,
                 )
-                texts: List[str] = matching_full_docs["documents"]
-                print(f"Doc {matched_doc} has {len(texts)} sentences")
-
-                DOC_ID: str = matched_doc
-                print(f"Doc ID: {DOC_ID}")
-
-                # - some documents are LONG, batch them into smaller chunks
-                batches = get_sentence_batches(texts, TOKEN_LEN)
-                sentence_batch_map = batches["map"]
-                batches = batches["batches"]
-
-                for batch, batch_texts in batches.items():
-                    print(f"Working with batch {batch + 1}/{len(batches)}")
-                    full_text: str = " ".join(batch_texts)
-                    prev_info: str = ""
-                    # no memory for the first batch
-                    if len(QUERY_MEMORY) > 0:
-                        prev_info = pred(
-                            instruction=memory_prompt.format(
-                                previous_information=QUERY_MEMORY,
-                                query=query,
-                                DOC_ID=DOC_ID,
-                            ),
+            )
+            TOKEN_LEN: int = get_token_budget(
+                llm_ctx_len,
+                n_predict=new_tokens,
+                prompt_tokens=prompt_tokens,
+                memory_tokens=MEMORY_TOKENS,
+            )
+            # rounded down, so queries of similar length share cached batches
+            TOKEN_LEN = max(TOKEN_LEN // BUDGET_STEP * BUDGET_STEP, BUDGET_STEP)
+            batches = doc_cache.batches(matched_doc, TOKEN_LEN, count_tokens)
+            sentence_batch_map = batches["map"]
+            batches = batches["batches"]
+
+            for batch, batch_texts in batches.items():
+                print(f"Working with batch {batch + 1}/{len(batches)}")
+                full_text: str = " ".join(batch_texts)
+                n_batches += 1
+                # no memory for the first batch
+                prev_info: str = memory.context(DOC_ID)
+                if triage:
+                    try:
+                        triage_result = triage_llm(
+                            query=query,
+                            text=full_text,
                             ip_address=ip_address,
                             port=port,
-                            max_tokens=1000,
-                            use_schema="summary",
+                            doc_id=DOC_ID,
+                            prompt_source=question_and_reason_prompt,
+                            lang=lang,
+                            deadline=deadline,
+                        )
+                    except (LLMTimeoutError, requests.RequestException) as e:
+                        # when in doubt, do the full analysis
+                        print(f"Triage failed ({e!r}). Running the full analysis")
+                        triage_result = None
+                    if triage_result is not None and not _passes_triage(
+                        triage_result, triage_min_score, triage_min_prob
+                    ):
+                        print(f"Triage: skipping batch {batch + 1} of {DOC_ID}: {triage_result}")
+                        n_triaged += 1
+                        continue
+
+                print(f"Getting preds from LLM with previous info: {prev_info}")
+
+                ask_kwargs = dict(
+                    query=query,
+                    text=full_text,
+                    ip_address=ip_address,
+                    port=port,
+                    extra=prev_info,
+                    doc_id=DOC_ID,
+                    tokens=new_tokens,
+                    prompt_source=question_and_reason_prompt,
+                    verbose=False,
+                    lang=lang,
+                    deadline=deadline,
+                )
+                metrics: Dict[str, Any] = {}
+                try:
+                    # a hedged call needs whole responses, so it is not streamed
+                    if stream and not hedge:
+                        llm_output, metrics = _stream_llm_output(
+                            matched_doc, **ask_kwargs
                         )
-                        prev_info = parse_llm_output(prev_info)
-                        print(f"Identified previous information: {prev_info}")
-                        if isinstance(prev_info, dict) and "summary" in prev_info:
-                            prev_info = prev_info["summary"]
-
-                    print(f"Getting preds from LLM with previous info: {prev_info}")
-
-                    llm_output = ask_llm(
-                        query=query,
-                        text=full_text,
-                        ip_address=ip_address,
-                        port=port,
-                        extra=prev_info,
-                        doc_id=DOC_ID,
-                        tokens=new_tokens,
-                        prompt_source=question_and_reason_prompt,
-                        verbose=False,
-                        lang=lang,
+                    else:
+                        llm_output = ask_llm(**ask_kwargs, hedge=hedge, metrics=metrics)
+                except (LLMTimeoutError, requests.RequestException) as e:
+                    print(f"Error: LLM call failed ({e!r})")
+                    st.warning(
+                        f"Skipping {matched_doc} (batch {batch + 1}): the LLM did not respond in time."
                     )
+                    continue
+                print(f"LLM metrics: {metrics}")
+
+                tmp_summary: str = ""
+                if isinstance(llm_output, dict) and "summary" in llm_output:
+                    tmp_summary = llm_output["summary"]
+                memory.add(tmp_summary)
+                QUERY_MEMORY = [prev_info, tmp_summary]
+                print(f"Updated previous info:", QUERY_MEMORY)
+                json_record = {
+                    "id": matched_doc,
+                    "batch": batch,
+                    "query": query,
+                    "llm_output": llm_output,
+                    "sentences_in_batch": sentence_batch_map[batch],
+                    "text": full_text,
+                    "memory": QUERY_MEMORY,
+                }
+                json_record["metrics"] = metrics
+                if matched_doc in hits:
+                    # rank, score and matching sent_ids of the document
+                    json_record["retrieval"] = hits[matched_doc]
 
-                    tmp_summary: str = ""
-                    if isinstance(llm_output, dict) and "summary" in llm_output:
-                        tmp_summary = llm_output["summary"]
-                    QUERY_MEMORY = [prev_info, tmp_summary]
-                    print(f"Updated previous info:", QUERY_MEMORY)
-                    json_record = {
-                        "id": matched_doc,
-                        "batch": batch,
-                        "query": query,
-                        "llm_output": llm_output,
-                        "sentences_in_batch": sentence_batch_map[batch],
-                        "text": full_text,
-                        "memory": QUERY_MEMORY,
+                try:
+                    keys = llm_output.keys()
+                    assert "questions" in keys
+                    assert "score" in keys
+                    assert "summary" in keys
+                except (AssertionError, AttributeError):
+                    print("Error: missing keys in llm_output")
+                    print(llm_output)
+                    print("___")
+                    st.warning(
+                        f"Skipping {matched_doc} (batch {batch + 1}): the LLM output could not be parsed."
+                    )
+                    llm_output = {
+                        "questions": ["Error generating questions..."],
+                        "score": -1,
+                        "summary": "",
                     }
+                    continue
 
-                    try:
-                        keys = llm_output.keys()
-                        assert "questions" in keys
-                        assert "score" in keys
-                        assert "summary" in keys
-                    except AssertionError:
-                        print("Error: missing keys in llm_output")
-                        print(llm_output)
-                        print("___")
-                        llm_output = {
-                            "questions": ["Error generating questions..."],
-                            "score": -1,
-                            "summary": "",
-                        }
-                        continue
+                with st.expander(
+                    f"Results for {matched_doc} (relevance score: {llm_output['score']}/3)"
+                ):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.markdown(f"#### Query\n{query}")
+                        st.markdown(f"#### Generated questions")
+                        for q in llm_output["questions"]:
+                            if "question" in q:
+                                st.markdown(f"- {q['question']}")
+                        st.markdown(f"#### Summary\n{llm_output['summary']}")
 
-                    with st.expander(
-                        f"Results for {matched_doc} (relevance score: {llm_output['score']}/3)"
-                    ):
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.markdown(f"#### Query\n{query}")
-                            st.markdown(f"#### Generated questions")
-                            for q in llm_output["questions"]:
-                                if "question" in q:
-                                    st.markdown(f"- {q['question']}")
-                            st.markdown(f"#### Summary\n{llm_output['summary']}")
-
-                            st.markdown(f"#### Memory")
-                            for _prev_info in QUERY_MEMORY:
-                                if len(_prev_info) > 3:
-                                    st.markdown(f"- {_prev_info}")
-
-                        with col2:
-                            st.markdown(f"#### Full text")
-                            st.write(full_text)
-                        st.divider()
-                    writer.write(json_record)
+                        st.markdown(f"#### Memory")
+                        for _prev_info in QUERY_MEMORY:
+                            if len(_prev_info) > 3:
+                                st.markdown(f"- {_prev_info}")
+
+                    with col2:
+                        st.markdown(f"#### Full text")
+                        st.write(full_text)
+                    st.divider()
+                writer.write(json_record)
+
+    memory.close()
+    print(f"Memory for query {query}: {memory.stats()}")
+    if triage:
+        print(f"Triage skipped {n_triaged}/{n_batches} batches for query: {query}")
+        st.caption(f"Skipped {n_triaged} of {n_batches} text batches as irrelevant.")
+    return output_path
+
+
+def run_rag(
+    queries: List[str],
+    collection: VectorStore,
+    ip_address: str,
+    port: int,
+    lang: str = "en",
+    top_n: int = 10,
+    retrieval: str = "max",  # "sentences", or a document score in utils.chroma.AGGREGATIONS
+    hybrid: bool = True,  # fuse the vector ranking with the bm25 keyword index
+    llm_ctx_len: int = 8168,
+    new_tokens: int = 2048,
+    stream: bool = True,  # render partial llm output while it is generated
+    deadline: float = None,  # seconds per llm call (retries included), None: no limit
+    hedge: bool = False,  # copy slow llm calls to a second server (needs several servers)
+    triage: bool = False,  # single-token relevance check before the full generation
+    triage_min_score: int = 1,  # batches scoring lower are skipped...
+    triage_min_prob: float = None,  # ...unless P(score >= triage_min_score) reaches this
+    memory_policy: str = "always",  # see utils.memory.MEMORY_POLICIES
+    memory_every_n: int = 3,  # for the "every_n" policy
+    memory_background: bool = False,  # compact memory off the critical path
+    query_concurrency: int = None,  # queries run in parallel, None: one per llm slot
+) -> str:
+    # print all locals that rag is running with:
+    print(locals())
+
+    start_of_program: str = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if retrieval != "sentences" and retrieval not in AGGREGATIONS:
+        raise ValueError(f"Unknown retrieval {retrieval}, choose sentences or {AGGREGATIONS}")
+    if top_n == -1:
+        top_n = len(get_catalog(collection))
+
+    llm_client = get_llm_client(ip_address, port)
+    if llm_client.n_ctx and llm_client.n_ctx < llm_ctx_len:
+        print(
+            f"Warning: the server context ({llm_client.n_ctx}) is shorter than "
+            f"llm_ctx_len ({llm_ctx_len}). Long batches will be truncated."
+        )
+    # real token counts from the server tokenizer (batched), cached per sentence
+    count_tokens = TokenCounter(llm_client.tokenize, llm_client.count_tokens)
+
+    case_folder = f"RAG_Top{top_n}_{start_of_program}"
+    rag_path = os.path.join("output", case_folder)
+
+    # retrieve for all queries in one embedding batch and one search call
+    rankings: Dict[str, List[Dict[str, Any]]] = {}
+    if retrieval != "sentences":
+        lexical = get_bm25_index(collection) if hybrid else None
+        rankings = dict(
+            zip(
+                queries,
+                get_ranked_documents_batch(
+                    collection, queries, top_n, aggregation=retrieval, lexical=lexical
+                ),
+            )
+        )
+
+    run_query = partial(
+        _run_query,
+        collection=collection,
+        doc_cache=DocumentCache(collection),
+        rag_path=rag_path,
+        ip_address=ip_address,
+        port=port,
+        lang=lang,
+        top_n=top_n,
+        retrieval=retrieval,
+        rankings=rankings,
+        llm_ctx_len=llm_ctx_len,
+        new_tokens=new_tokens,
+        count_tokens=count_tokens,
+        stream=stream,
+        deadline=deadline,
+        hedge=hedge,
+        triage=triage,
+        triage_min_score=triage_min_score,
+        triage_min_prob=triage_min_prob,
+        memory_policy=memory_policy,
+        memory_every_n=memory_every_n,
+        memory_background=memory_background,
+    )
+    # queries are independent: run as many at once as the server(s) have slots
+    if query_concurrency is None:
+        query_concurrency = llm_client.n_slots
+    query_concurrency = max(1, min(query_concurrency, len(queries)))
+    print(f"Running {len(queries)} queries, {query_concurrency} at a time")
+
+    if query_concurrency == 1:
+        for i, query in enumerate(queries):
+            run_query(query, i)
+    else:
+        # one section per query, filled in as its results arrive
+        containers = [st.container() for _ in queries]
+        script_ctx = get_script_run_ctx()
+
+        def run_in_container(query: str, query_index: int, container) -> str:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+            with container:
+                return run_query(query, query_index)
+
+        with ThreadPoolExecutor(max_workers=query_concurrency) as pool:
+            futures = [
+                pool.submit(run_in_container, query, i, container)
+                for i, (query, container) in enumerate(zip(queries, containers))
+            ]
+            for future in futures:
+                future.result()
+
+    cache = get_completion_cache()
+    if cache is not None:
+        print(f"LLM completion cache: {cache.stats()}")
     return rag_path
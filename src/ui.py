@@ -24,7 +24,7 @@ from datetime import datetime
 import pandas as pd
 
 from combine import meta_summary
-from initialize import load_and_cache_documents, populate_collection
+from initialize import load_and_cache_documents, populate_collection, warm_up_resources
 from rag import run_rag
 
 default_queries = [
@@ -83,8 +83,24 @@ subtext = "query-based analysis for criminal investigations"
 st.sidebar.header("Server Configuration")
 default_ip = "krirag-api"
 default_ip = "localhost"
-ip_address = st.sidebar.text_input("LLM Docker Name or IP Address", value=default_ip)
+ip_address = st.sidebar.text_input(
+    "LLM Docker Name or IP Address",
+    value=default_ip,
+    help="Comma-separate several servers (e.g. `host-a, host-b:8503`) to spread requests across them.",
+)
 port = st.sidebar.number_input("API Port", value=8502, step=1)
+deadline = st.sidebar.number_input(
+    "LLM call deadline (seconds)",
+    value=0,
+    min_value=0,
+    step=30,
+    help="Give up on an LLM call (retries included) after this long. 0: no limit.",
+)
+hedge = st.sidebar.checkbox(
+    "Hedge slow LLM calls",
+    value=False,
+    help="With several servers, send a copy of a call that is slower than usual to a second server. Calls are then not streamed.",
+)
 
 # Add listeners for changes
 if st.sidebar.button("Update Configuration"):
@@ -111,16 +127,18 @@ if "to_delete" not in st.session_state:
 
 with col1:
     st.write("### Data:")
-    txt_upload = "Upload a single .txt file or a zip of multiple .txt files. The file names should have identifiable names for KriRAG to reference results."
+    txt_upload = "Upload a single .txt/.json/.jsonl file or a zip of multiple files. The file names should have identifiable names for KriRAG to reference results."
 
     lang_selector = st.selectbox(
         "Select language:",
         supported_languagess,
         index=supported_languagess.index(default_lang),
     )
+    # WARMUP=1: the model etc. load in the background while the page is used
+    warm_up_resources([lang_selector])
     
     _uploaded = st.file_uploader(
-        txt_upload, type=["txt", "zip"], accept_multiple_files=False
+        txt_upload, type=["txt", "json", "jsonl", "zip"], accept_multiple_files=False
     )
 
     if _uploaded:
@@ -163,7 +181,7 @@ if st.session_state.is_initialized and "data" in initialization:
     top_n = st.slider(
         "Number of candidate documents for each query.",
         1,
-        min(initialization["num_pages"], 100),
+        max(min(len(initialization["catalog"]), 100), 2),
         1,
     )
     if st.session_state.get("last_top_n") != top_n:
@@ -173,6 +191,23 @@ if st.session_state.is_initialized and "data" in initialization:
         "Note: a higher slider value will increase processing time, but will likely find more relevant documents."
     )
 
+    triage = st.checkbox(
+        "Quick relevance check",
+        value=False,
+        help="Ask the LLM for a relevance score first, and only analyze text it does not consider irrelevant. Faster, but may skip borderline documents.",
+    )
+
+    memory_policy = st.selectbox(
+        "Memory update:",
+        ["always", "every_n", "tokens", "truncate"],
+        format_func={
+            "always": "Summarize after every text batch (slowest)",
+            "every_n": "Summarize after every 3 findings",
+            "tokens": "Summarize when the memory is full",
+            "truncate": "Keep the latest findings, no summaries (fastest)",
+        }.get,
+    )
+
     if st.button("Run KriRAG", disabled=st.session_state.rag_started):
         st.session_state.rag_started = True
         with st.spinner("Analyzing..."):
@@ -180,6 +215,8 @@ if st.session_state.is_initialized and "data" in initialization:
                 initialization["data"],
                 collection_name=collection_name,
                 delete=st.session_state.to_delete,
+                lang=lang_selector,
+                catalog=initialization["catalog"],
             )
             rag_path = run_rag(
                 queries=queries,
@@ -190,6 +227,10 @@ if st.session_state.is_initialized and "data" in initialization:
                 top_n=top_n,
                 llm_ctx_len=8168,
                 new_tokens=4096,
+                triage=triage,
+                memory_policy=memory_policy,
+                deadline=deadline or None,
+                hedge=hedge,
             )
         with st.spinner("Processing findings..."):
             meta = meta_summary(rag_path, ip_address=ip_address, port=port)
@@ -9,13 +9,121 @@
 # - Tollef Jørgensen (Initial Development, 2024)
 # ------------------------------------------------------------------------------
 
-from collections import defaultdict
-from typing import Any, Dict, List
+import math
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, List
 
+# average tokens per whitespace-separated word of llama-style tokenizers on
+# english/norwegian prose, used when no tokenizer is available
+TOKENS_PER_WORD: float = 1.3
+# texts sent per batched /tokenize call
+TOKENIZE_BATCH: int = 256
+
+
+def approx_token_count(text: str) -> int:
+    return math.ceil(len(text.split()) * TOKENS_PER_WORD)
+
+
+class TokenCounter:
+    """
+    Counts tokens with a tokenizer (e.g. `LLMClient.tokenize`, llama.cpp's
+    /tokenize), caching the count of each text. `count_many` counts the
+    uncached texts of a list with batched calls (`tokenize_many`, e.g.
+    `LLMClient.count_tokens`) when given. Falls back to `approx_token_count`
+    if the tokenizer is unavailable.
+    """
+
+    def __init__(
+        self,
+        tokenize: Callable[[str], List[int]] = None,
+        tokenize_many: Callable[[List[str]], List[int]] = None,
+        max_cache: int = 100_000,
+    ):
+        self.tokenize = tokenize
+        self.tokenize_many = tokenize_many
+        self.max_cache = max_cache
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                return self._cache[text]
+        count = self._count(text)
+        self._put(text, count)
+        return count
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        with self._lock:
+            missing = list(dict.fromkeys(t for t in texts if t not in self._cache))
+        for start in range(0, len(missing), TOKENIZE_BATCH):
+            if self.tokenize_many is None or self.tokenize is None:
+                break
+            batch = missing[start : start + TOKENIZE_BATCH]
+            try:
+                counts = self.tokenize_many(batch)
+            except Exception as e:
+                print(f"Batched tokenizer unavailable ({e}). Counting texts one by one.")
+                self.tokenize_many = None
+                break
+            for text, count in zip(batch, counts):
+                self._put(text, count)
+        return [self(text) for text in texts]
+
+    def _put(self, text: str, count: int):
+        with self._lock:
+            self._cache[text] = count
+            if len(self._cache) > self.max_cache:
+                self._cache.popitem(last=False)
+
+    def _count(self, text: str) -> int:
+        if self.tokenize is None:
+            return approx_token_count(text)
+        try:
+            return len(self.tokenize(text))
+        except Exception as e:
+            print(f"Tokenizer unavailable ({e}). Falling back to word counts.")
+            self.tokenize = None
+            return approx_token_count(text)
+
+
+def get_token_budget(
+    llm_ctx_len: int,
+    n_predict: int,
+    prompt_tokens: int = 0,
+    memory_tokens: int = 0,
+) -> int:
+    # what is left of the context for document text
+    budget = llm_ctx_len - n_predict - prompt_tokens - memory_tokens
+    if budget <= 0:
+        raise ValueError(
+            f"No room for text: context {llm_ctx_len} - output {n_predict} - "
+            f"prompt {prompt_tokens} - memory {memory_tokens} = {budget} tokens"
+        )
+    return budget
+
+
+def get_sentence_batches(
+    texts: List[str],
+    TOKEN_LEN: int,
+    count_tokens: Callable[[str], int] = None,
+) -> Dict[str, Any]:
+    """
+    Greedily pack consecutive sentences into batches of at most TOKEN_LEN
+    tokens. A sentence longer than the budget gets a batch of its own.
+    Without `count_tokens`, tokens are estimated from word counts.
+    """
+    if count_tokens is None:
+        count_tokens = approx_token_count
+    if isinstance(count_tokens, TokenCounter):
+        counts = count_tokens.count_many(texts)
+    else:
+        counts = [count_tokens(sentence) for sentence in texts]
 
-def get_sentence_batches(texts: List[str], TOKEN_LEN: int) -> Dict[str, Any]:
     token_batches = defaultdict(list)
-    current_token_count = 0
+    batch_tokens = defaultdict(int)
     current_batch = 0
 
     # also add a mapping of sentences that span the current batch
@@ -23,15 +131,17 @@ def get_sentence_batches(texts: List[str], TOKEN_LEN: int) -> Dict[str, Any]:
     sentence_batch_map = defaultdict(list)
 
     for s_id, sentence in enumerate(texts):
-        sentence_batch_map[current_batch].append(s_id)
-        tokens_in_sent = len(sentence.split())
-        current_token_count += tokens_in_sent
-        if current_token_count > TOKEN_LEN:
-            current_token_count = 0
+        # +1: the space joining sentences in a batch
+        tokens_in_sent = counts[s_id] + 1
+        current = batch_tokens[current_batch]
+        if current > 0 and current + tokens_in_sent > TOKEN_LEN:
             current_batch += 1
+        sentence_batch_map[current_batch].append(s_id)
         token_batches[current_batch].append(sentence)
+        batch_tokens[current_batch] += tokens_in_sent
 
     return {
         "batches": token_batches,
         "map": sentence_batch_map,
+        "tokens": batch_tokens,
     }
@@ -0,0 +1,281 @@
+# ------------------------------------------------------------------------------
+# File: bm25.py
+# Description: on-disk BM25 inverted index over the sentences of a collection,
+#              for exact terms (names, addresses, plate numbers, law
+#              references) that dense embeddings retrieve poorly.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import logging
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+from nltk.stem.snowball import SnowballStemmer
+
+from utils.catalog import CHROMA_PATH
+
+BM25_FOLDER = os.path.join(CHROMA_PATH, "bm25")
+BM25_K1 = 1.5
+BM25_B = 0.75
+BUILD_CHUNK = 4096  # sentences whose postings are collected before becoming arrays
+
+_word = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=None)
+def _stemmer(lang: str):
+    if lang in SnowballStemmer.languages:
+        return lru_cache(maxsize=100_000)(SnowballStemmer(lang).stem)
+    return lambda token: token
+
+
+def tokenize(text: str, lang: str = "english") -> List[str]:
+    # lowercased word/number tokens, stemmed for the language if supported
+    stem = _stemmer(lang)
+    return [stem(token) for token in _word.findall(text.lower())]
+
+
+class BM25Index:
+    """
+    Sentence-level BM25 over compressed-sparse postings:
+    the sentences containing terms[t] are postings[indptr[t]:indptr[t + 1]].
+    Terms and document names are plain lists, stored on disk as utf-8 blobs.
+    """
+
+    def __init__(
+        self,
+        lang: str,
+        terms: List[str],
+        indptr: np.ndarray,
+        postings: np.ndarray,
+        tfs: np.ndarray,
+        lengths: np.ndarray,
+        documents: List[str],
+        sent_documents: np.ndarray,
+        sent_ids: np.ndarray,
+    ):
+        self.lang = lang
+        self.terms = terms
+        self.indptr = indptr
+        self.postings = postings
+        self.tfs = tfs
+        self.lengths = lengths
+        self.documents = documents
+        self.sent_documents = sent_documents
+        self.sent_ids = sent_ids
+        self._term_index = {t: i for i, t in enumerate(terms)}
+        self._avg_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, data: Iterable[Dict[str, Any]], lang: str = "english") -> "BM25Index":
+        # data: sentence records (id/page_id/sent_id/text)
+        builder = BM25Builder(lang)
+        for row in data:
+            builder.add(row)
+        return builder.build()
+
+    def search(
+        self, queries: List[str], n_results: int
+    ) -> Tuple[List[List[Dict[str, Any]]], List[List[float]]]:
+        # per query: metadatas ({"document", "sent_id"}) and scores, best first
+        all_metadatas, all_scores = [], []
+        n = len(self)
+        for query in queries:
+            scores = np.zeros(n, dtype=np.float32)
+            for term in set(tokenize(query, self.lang)):
+                t = self._term_index.get(term)
+                if t is None:
+                    continue
+                start, end = self.indptr[t], self.indptr[t + 1]
+                sents = self.postings[start:end]
+                tf = self.tfs[start:end].astype(np.float32)
+                df = end - start
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[sents] / self._avg_length)
+                scores[sents] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            hits = np.flatnonzero(scores)
+            if len(hits) > n_results:
+                hits = hits[np.argpartition(-scores[hits], n_results - 1)[:n_results]]
+            hits = hits[np.argsort(-scores[hits], kind="stable")]
+            all_metadatas.append(
+                [
+                    {
+                        "document": self.documents[self.sent_documents[s]],
+                        "sent_id": int(self.sent_ids[s]),
+                    }
+                    for s in hits
+                ]
+            )
+            all_scores.append(scores[hits].tolist())
+        return all_metadatas, all_scores
+
+
+class BM25Builder:
+    """
+    Collects sentence records one at a time (e.g. while they stream into the
+    vector store), so the index is built without another pass over the data.
+    Postings are kept as compact (term id, sentence, tf) arrays, converted
+    every BUILD_CHUNK sentences, and sorted into place by `build`.
+    """
+
+    def __init__(self, lang: str = "english"):
+        self.lang = lang
+        self.vocabulary: Dict[str, int] = {}
+        self.documents: Dict[str, int] = {}
+        self.n_sentences = 0
+        self._postings: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._sentences: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._reset()
+
+    def _reset(self):
+        self._term_ids, self._sents, self._tfs = [], [], []
+        self._lengths, self._sent_documents, self._sent_ids = [], [], []
+
+    def add(self, row: Dict[str, Any]):
+        tokens = tokenize(row["text"], self.lang)
+        for term, tf in Counter(tokens).items():
+            self._term_ids.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+            self._sents.append(self.n_sentences)
+            self._tfs.append(min(tf, 65535))
+        self._lengths.append(len(tokens))
+        self._sent_documents.append(self.documents.setdefault(row["id"], len(self.documents)))
+        self._sent_ids.append(row["sent_id"])
+        self.n_sentences += 1
+        if len(self._lengths) >= BUILD_CHUNK:
+            self._flush()
+
+    def _flush(self):
+        self._postings.append(
+            (
+                np.array(self._term_ids, dtype=np.int32),
+                np.array(self._sents, dtype=np.int32),
+                np.array(self._tfs, dtype=np.uint16),
+            )
+        )
+        self._sentences.append(
+            (
+                np.array(self._lengths, dtype=np.int32),
+                np.array(self._sent_documents, dtype=np.int32),
+                np.array(self._sent_ids, dtype=np.int32),
+            )
+        )
+        self._reset()
+
+    def build(self) -> BM25Index:
+        self._flush()
+        term_ids, sents, tfs = (np.concatenate(c) for c in zip(*self._postings))
+        lengths, sent_documents, sent_ids = (np.concatenate(c) for c in zip(*self._sentences))
+        # terms in sorted order; postings grouped by term, sentences ascending
+        terms = sorted(self.vocabulary)
+        rank = np.empty(len(terms), dtype=np.int32)
+        rank[[self.vocabulary[t] for t in terms]] = np.arange(len(terms), dtype=np.int32)
+        term_ranks = rank[term_ids]
+        order = np.argsort(term_ranks, kind="stable")
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(term_ranks, minlength=len(terms)))
+        return BM25Index(
+            lang=self.lang,
+            terms=terms,
+            indptr=indptr,
+            postings=sents[order],
+            tfs=tfs[order],
+            lengths=lengths,
+            documents=list(self.documents),
+            sent_documents=sent_documents,
+            sent_ids=sent_ids,
+        )
+
+
+def _pack_strings(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # one utf-8 blob plus end offsets: a fixed-width unicode array would pad
+    # every entry to the longest one (e.g. a 400-character token)
+    encoded = [v.encode("utf-8") for v in values]
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, np.cumsum([len(e) for e in encoded], dtype=np.int64)
+
+
+def _unpack_strings(blob: np.ndarray, ends: np.ndarray) -> List[str]:
+    data = blob.tobytes()
+    starts = [0] + ends[:-1].tolist()
+    return [data[a:b].decode("utf-8") for a, b in zip(starts, ends.tolist())]
+
+
+def bm25_path(collection_name: str) -> str:
+    return os.path.join(BM25_FOLDER, f"{collection_name}.npz")
+
+
+def save_bm25_index(collection_name: str, index: BM25Index):
+    os.makedirs(BM25_FOLDER, exist_ok=True)
+    path = bm25_path(collection_name)
+    # write-then-rename, so readers never see a partial file
+    terms, term_ends = _pack_strings(index.terms)
+    documents, document_ends = _pack_strings(index.documents)
+    with open(f"{path}.tmp", "wb") as f:
+        np.savez(
+            f,
+            lang=np.array(index.lang),
+            terms=terms,
+            term_ends=term_ends,
+            indptr=index.indptr,
+            postings=index.postings,
+            tfs=index.tfs,
+            lengths=index.lengths,
+            documents=documents,
+            document_ends=document_ends,
+            sent_documents=index.sent_documents,
+            sent_ids=index.sent_ids,
+        )
+    os.replace(f"{path}.tmp", path)
+
+
+def load_bm25_index(collection_name: str) -> BM25Index:
+    path = bm25_path(collection_name)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as f:
+        arrays = {k: f[k] for k in f.files}
+    arrays["lang"] = str(arrays["lang"])
+    if "term_ends" in arrays:
+        arrays["terms"] = _unpack_strings(arrays["terms"], arrays.pop("term_ends"))
+        arrays["documents"] = _unpack_strings(arrays["documents"], arrays.pop("document_ends"))
+    else:
+        # indexes saved as fixed-width unicode arrays
+        arrays["terms"] = arrays["terms"].tolist()
+        arrays["documents"] = arrays["documents"].tolist()
+    return BM25Index(**arrays)
+
+
+def delete_bm25_index(collection_name: str):
+    path = bm25_path(collection_name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_bm25_index(collection, lang: str = "english") -> BM25Index:
+    # collection: a utils.vectorstore.VectorStore
+    # collections created before the index existed are indexed once
+    index = load_bm25_index(collection.name)
+    if index is None:
+        logging.info(f"No BM25 index for {collection.name}, building it from the collection")
+        result = collection.get_by_document()
+        rows = sorted(
+            (
+                {"id": meta["document"], "sent_id": meta["sent_id"], "text": text}
+                for text, meta in zip(result["documents"], result["metadatas"])
+            ),
+            key=lambda row: (row["id"], row["sent_id"]),
+        )
+        index = BM25Index.build(rows, lang)
+        save_bm25_index(collection.name, index)
+    return index
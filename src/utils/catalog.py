@@ -0,0 +1,106 @@
+# ------------------------------------------------------------------------------
+# File: catalog.py
+# Description: compact per-collection document catalog for KriRAG. Holds the
+#              document ids, sentence/page counts and content hashes, so that
+#              listing documents does not require reading every sentence's
+#              metadata from Chroma.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List
+
+CHROMA_PATH = "chroma"  # where chromadb.PersistentClient stores collections
+CATALOG_FOLDER = os.path.join(CHROMA_PATH, "catalog")
+
+
+def build_catalog(data: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Catalog from sentence records (id/page_id/sent_id/text), in document order:
+    {document: {"sentences": int, "pages": int, "hash": str}}
+    """
+    hashes = {}
+    pages = {}
+    catalog: Dict[str, Dict[str, Any]] = {}
+    for row in data:
+        document = row["id"]
+        if document not in catalog:
+            catalog[document] = {"sentences": 0, "pages": 0, "hash": ""}
+            hashes[document] = hashlib.sha256()
+            pages[document] = set()
+        catalog[document]["sentences"] += 1
+        pages[document].add(row["page_id"])
+        hashes[document].update(row["text"].encode("utf-8"))
+        hashes[document].update(b"\n")
+    for document, entry in catalog.items():
+        entry["pages"] = len(pages[document])
+        entry["hash"] = hashes[document].hexdigest()
+    return catalog
+
+
+def diff_catalogs(
+    old: Dict[str, Dict[str, Any]], new: Dict[str, Dict[str, Any]]
+) -> Dict[str, List[str]]:
+    # documents to add, re-embed (content changed), remove and keep
+    return {
+        "added": sorted(d for d in new if d not in old),
+        "changed": sorted(d for d in new if d in old and old[d]["hash"] != new[d]["hash"]),
+        "removed": sorted(d for d in old if d not in new),
+        "unchanged": sorted(d for d in new if d in old and old[d]["hash"] == new[d]["hash"]),
+    }
+
+
+def catalog_path(collection_name: str) -> str:
+    return os.path.join(CATALOG_FOLDER, f"{collection_name}.json")
+
+
+def save_catalog(collection_name: str, catalog: Dict[str, Dict[str, Any]]):
+    os.makedirs(CATALOG_FOLDER, exist_ok=True)
+    path = catalog_path(collection_name)
+    # write-then-rename, so readers never see a partial file
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_catalog(collection_name: str) -> Dict[str, Dict[str, Any]]:
+    path = catalog_path(collection_name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def delete_catalog(collection_name: str):
+    path = catalog_path(collection_name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_catalog(collection) -> Dict[str, Dict[str, Any]]:
+    # collection: a utils.vectorstore.VectorStore
+    # collections created before the catalog existed are scanned once
+    catalog = load_catalog(collection.name)
+    if catalog is None:
+        logging.info(f"No catalog for {collection.name}, building it from the collection")
+        result = collection.get_by_document()
+        rows = sorted(
+            (
+                {
+                    "id": meta["document"],
+                    "page_id": meta["page_id"],
+                    "sent_id": meta["sent_id"],
+                    "text": text,
+                }
+                for text, meta in zip(result["documents"], result["metadatas"])
+            ),
+            key=lambda row: (row["id"], row["sent_id"]),
+        )
+        catalog = build_catalog(rows)
+        save_catalog(collection.name, catalog)
+    return catalog
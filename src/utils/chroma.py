@@ -11,14 +11,32 @@
 
 import logging
 import os
-from typing import List, Tuple
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Tuple
 
 import chromadb
+import numpy as np
 from chromadb import Client, Collection, Documents, EmbeddingFunction, Embeddings
 from chromadb.config import Settings
 from chromadb.utils.batch_utils import create_batches
 from pandas import DataFrame
-from sentence_transformers import SentenceTransformer
+
+from utils.batch import get_sentence_batches
+from utils.bm25 import BM25Index, delete_bm25_index
+from utils.catalog import delete_catalog
+from utils.resources import get_chroma_client
+from utils.vectorstore import (
+    ChromaStore,
+    LocalStore,
+    VectorStore,
+    delete_local_store,
+    local_store_path,
+)
+
+if TYPE_CHECKING:
+    # type hints only; torch is imported where a model is loaded
+    from sentence_transformers import SentenceTransformer
 
 
 class CustomEmbedder(EmbeddingFunction):
@@ -30,7 +48,8 @@ class CustomEmbedder(EmbeddingFunction):
         embeddings = self.model.encode(
             input, convert_to_numpy=True, batch_size=self.batch_size
         )
-        return [e.tolist() for e in embeddings]
+        # float32 rows (views into one array), not lists of python floats
+        return list(np.asarray(embeddings, dtype=np.float32))
 
 
 def get_collection(collection_name: str = "rag"):
@@ -44,19 +63,21 @@ def get_collection(collection_name: str = "rag"):
 def get_client(
     persist: bool = True,
     delete: bool = False,
-    embedding_model: SentenceTransformer = None,
+    embedding_model: "SentenceTransformer" = None,
     collection_name: str = "rag",
 ) -> Tuple[chromadb.Client, chromadb.Collection]:
-    _settings = Settings(anonymized_telemetry=False)
     if persist:
-        chroma_client = chromadb.PersistentClient(settings=_settings)
+        # one client per process, shared by all sessions (see utils/resources.py)
+        chroma_client = get_chroma_client()
     else:
-        chroma_client = chromadb.Client(settings=_settings)
+        chroma_client = chromadb.Client(settings=Settings(anonymized_telemetry=False))
 
     if delete:
         try:
             logging.info(f"Deleting collection {collection_name}")
             chroma_client.delete_collection(name=collection_name)
+            delete_catalog(collection_name)
+            delete_bm25_index(collection_name)
         except Exception as e:
             logging.error(e)
             logging.info("Proceeding as normal.")
@@ -69,6 +90,42 @@ def get_client(
     return chroma_client, collection
 
 
+def get_store(
+    backend: str = "chroma",
+    delete: bool = False,
+    embedding_model: "SentenceTransformer" = None,
+    collection_name: str = "rag",
+    dtype: str = "float32",
+    hnsw: bool = False,
+    rescore: bool = False,
+) -> Tuple[chromadb.Client, VectorStore]:
+    # chroma: (client, ChromaStore), local: (None, LocalStore); dtype/hnsw/rescore are local only
+    if backend == "chroma":
+        client, collection = get_client(
+            persist=True,
+            delete=delete,
+            embedding_model=embedding_model,
+            collection_name=collection_name,
+        )
+        return client, ChromaStore(collection)
+    if backend != "local":
+        raise ValueError(f"Unknown vector store {backend}, choose chroma or local")
+    if delete:
+        logging.info(f"Deleting local store {collection_name}")
+        delete_local_store(collection_name)
+        delete_catalog(collection_name)
+        delete_bm25_index(collection_name)
+    store = LocalStore(
+        local_store_path(collection_name),
+        embed=CustomEmbedder(embedding_model),
+        dtype=dtype,
+        hnsw=hnsw,
+        rescore=rescore,
+    )
+    logging.info(f"Init local store {collection_name}")
+    return None, store
+
+
 def peek(collection: chromadb.Collection, count: int):
     sample = collection.peek(limit=count)
     for key, val in sample.items():
@@ -84,7 +141,7 @@ def peek(collection: chromadb.Collection, count: int):
 
 def update_collection(
     client: Client,
-    model: SentenceTransformer,
+    model: "SentenceTransformer",
     df: DataFrame,
     collection: Collection,
     DOCUMENTS_TEXT_COLUMN,
@@ -103,7 +160,7 @@ def update_collection(
             )
 
         documents = df[DOCUMENTS_TEXT_COLUMN].tolist()
-        embeddings = model.encode(documents, show_progress_bar=True).tolist()
+        embeddings = model.encode(documents, show_progress_bar=True)
         ids = df.index.map(str).tolist()
 
         batches = create_batches(
@@ -123,10 +180,19 @@ def update_collection(
             )
 
 
+# how sentence hits are combined into a document score
+# max: best sentence, sum: all hits (favours documents with many hits),
+# rrf: reciprocal rank fusion, sum of 1 / (RRF_K + rank)
+AGGREGATIONS = ("max", "sum", "rrf")
+RRF_K = 60
+OVERSAMPLE = 10  # sentence hits fetched per requested document
+
+
 def get_matching_documents(
-    collection: Collection, query: str, n_results: int
+    collection: VectorStore, query: str, n_results: int
 ) -> List[str]:
-    query_result = collection.query(query_texts=query, n_results=n_results)
+    # sentence-level: the documents of the top n_results sentences, unranked
+    query_result = collection.query([query], n_results=n_results)
     query_result = {
         k: v[0] for k, v in query_result.items() if isinstance(v, list) and len(v) > 0
     }
@@ -134,3 +200,191 @@ def get_matching_documents(
     documents = [d["document"] for d in metadata]
     documents = sorted(list(set(documents)))
     return documents
+
+
+def aggregate_hits(
+    metadatas: List[Dict[str, Any]],
+    similarities: List[float],
+    aggregation: str = "max",
+) -> List[Dict[str, Any]]:
+    """
+    Combine ranked sentence hits (positive similarities, best first) into
+    documents, best first: [{"document", "rank", "score", "sent_ids"}],
+    sent_ids in hit order.
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {aggregation}, choose from {AGGREGATIONS}")
+    scores: Dict[str, float] = {}
+    sent_ids: Dict[str, List[int]] = {}
+    for rank, (meta, similarity) in enumerate(zip(metadatas, similarities)):
+        document = meta["document"]
+        score = 1 / (RRF_K + rank + 1) if aggregation == "rrf" else similarity
+        if document not in scores:
+            scores[document] = 0.0
+            sent_ids[document] = []
+        if aggregation == "max":
+            scores[document] = max(scores[document], score)
+        else:
+            scores[document] += score
+        sent_ids[document].append(meta["sent_id"])
+
+    # ties keep the order of each document's first hit
+    ranked = sorted(scores, key=lambda d: scores[d], reverse=True)
+    return [
+        {"document": d, "rank": r, "score": scores[d], "sent_ids": sent_ids[d]}
+        for r, d in enumerate(ranked, start=1)
+    ]
+
+
+def fuse_rankings(rankings: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    # reciprocal rank fusion of document rankings (e.g. vector and bm25)
+    scores: Dict[str, float] = {}
+    sent_ids: Dict[str, List[int]] = {}
+    for ranking in rankings:
+        for r in ranking:
+            document = r["document"]
+            scores[document] = scores.get(document, 0.0) + 1 / (RRF_K + r["rank"])
+            merged = sent_ids.setdefault(document, [])
+            merged.extend(i for i in r["sent_ids"] if i not in merged)
+    ranked = sorted(scores, key=lambda d: scores[d], reverse=True)
+    return [
+        {"document": d, "rank": r, "score": scores[d], "sent_ids": sent_ids[d]}
+        for r, d in enumerate(ranked, start=1)
+    ]
+
+
+def _similarities(distances: List[float]) -> List[float]:
+    # positive and decreasing with distance, for any distance space
+    return [1 / (1 + max(d, 0.0)) for d in distances]
+
+
+def get_ranked_documents(
+    collection: VectorStore,
+    query: str,
+    top_n: int,
+    aggregation: str = "max",
+    oversample: int = OVERSAMPLE,
+    lexical: BM25Index = None,
+) -> List[Dict[str, Any]]:
+    """
+    Document-level retrieval: fetch `top_n * oversample` sentence hits,
+    aggregate them per document and return the `top_n` best documents (fewer
+    only if the collection holds fewer). Fetches more hits while too few
+    distinct documents are found. With a `lexical` index, its document
+    ranking is fused with the vector ranking (RRF).
+    """
+    return get_ranked_documents_batch(
+        collection, [query], top_n, aggregation, oversample, lexical
+    )[0]
+
+
+def get_ranked_documents_batch(
+    collection: VectorStore,
+    queries: List[str],
+    top_n: int,
+    aggregation: str = "max",
+    oversample: int = OVERSAMPLE,
+    lexical: BM25Index = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    `get_ranked_documents` for several queries at once: the queries are
+    embedded in one encode batch and searched in one multi-query call.
+    Returns one ranking per query, in query order.
+    """
+    rankings: List[List[Dict[str, Any]]] = [[] for _ in queries]
+    total = collection.count()
+    if total == 0 or top_n <= 0 or not queries:
+        return rankings
+
+    pending = list(range(len(queries)))
+    n_results = min(max(top_n * oversample, top_n), total)
+    while pending:
+        # the store's embedder encodes all query texts in one batch
+        result = collection.query([queries[i] for i in pending], n_results=n_results)
+        if lexical is not None:
+            lexical_metadatas, lexical_scores = lexical.search(
+                [queries[i] for i in pending], n_results
+            )
+        short = []
+        for j, i in enumerate(pending):
+            ranked = aggregate_hits(
+                result["metadatas"][j], _similarities(result["distances"][j]), aggregation
+            )
+            if lexical is not None:
+                # exact terms (names, plate numbers, laws) the embeddings miss
+                ranked = fuse_rankings(
+                    [ranked, aggregate_hits(lexical_metadatas[j], lexical_scores[j], aggregation)]
+                )
+            rankings[i] = ranked[:top_n]
+            if len(ranked) < top_n and n_results < total:
+                short.append(i)
+        # only the queries with too few distinct documents search again (rare)
+        pending = short
+        n_results = min(n_results * 2, total)
+    return rankings
+
+
+class DocumentCache:
+    """
+    Per-run cache of each document's sentences (ordered by sent_id) and of
+    its sentence batches per token budget, so a document matched by several
+    queries is fetched and batched once. Evicts least recently used documents
+    once more than `max_sentences` sentences are held.
+    """
+
+    def __init__(self, collection: VectorStore, max_sentences: int = 500_000):
+        self.collection = collection
+        self.max_sentences = max_sentences
+        self._sentences: OrderedDict = OrderedDict()
+        self._batches: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def prefetch(self, documents: List[str]):
+        # one bulk get for all documents not cached yet
+        with self._lock:
+            missing = [d for d in documents if d not in self._sentences]
+        if not missing:
+            return
+        result = self.collection.get_by_document(missing)
+        grouped: Dict[str, List[Tuple[int, str]]] = {d: [] for d in missing}
+        for text, meta in zip(result["documents"], result["metadatas"]):
+            grouped.setdefault(meta["document"], []).append((meta["sent_id"], text))
+        with self._lock:
+            for document, sentences in grouped.items():
+                self._put(document, [text for _, text in sorted(sentences)])
+
+    def sentences(self, document: str) -> List[str]:
+        with self._lock:
+            if document in self._sentences:
+                self._sentences.move_to_end(document)
+                return self._sentences[document]
+        self.prefetch([document])
+        with self._lock:
+            return self._sentences.get(document, [])
+
+    def batches(
+        self,
+        document: str,
+        token_budget: int,
+        count_tokens: Callable[[str], int] = None,
+    ) -> Dict[str, Any]:
+        key = (document, token_budget)
+        with self._lock:
+            if key in self._batches:
+                return self._batches[key]
+        batches = get_sentence_batches(self.sentences(document), token_budget, count_tokens)
+        with self._lock:
+            if document in self._sentences:
+                self._batches[key] = batches
+        return batches
+
+    def _put(self, document: str, sentences: List[str]):
+        if document in self._sentences:
+            self._size -= len(self._sentences.pop(document))
+        self._sentences[document] = sentences
+        self._size += len(sentences)
+        while self._size > self.max_sentences and len(self._sentences) > 1:
+            evicted, evicted_sentences = self._sentences.popitem(last=False)
+            self._size -= len(evicted_sentences)
+            self._batches = {k: v for k, v in self._batches.items() if k[0] != evicted}
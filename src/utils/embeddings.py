@@ -0,0 +1,155 @@
+# ------------------------------------------------------------------------------
+# File: embeddings.py
+# Description: persistent embedding cache for KriRAG, keyed by (model id,
+#              sentence hash), so re-ingesting unchanged sentences never
+#              re-encodes them.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import hashlib
+import os
+import threading
+from typing import Callable, Dict, List
+
+import numpy as np
+
+EMBEDDING_CACHE_PATH = os.path.join("cache", "embeddings")
+KEY_BYTES = 16
+# openvino weights of the saved model per precision (int8: `python install.py --int8`)
+OPENVINO_FILES = {
+    "fp32": "openvino/openvino_model.xml",
+    "int8": "openvino/openvino_model_qint8_quantized.xml",
+}
+# small files that identify a saved SentenceTransformer (weights are too big to hash)
+_MODEL_ID_FILES = (
+    "config.json",
+    "modules.json",
+    "sentence_bert_config.json",
+    "config_sentence_transformers.json",
+    "tokenizer_config.json",
+)
+
+
+def model_id(model_path: str, precision: str = None) -> str:
+    # content id of a model folder: its configs plus the names/sizes of the
+    # other files (only the weights of `precision`, if given)
+    weights = None
+    if precision is not None:
+        xml = OPENVINO_FILES[precision]
+        weights = {xml, xml.replace(".xml", ".bin")}
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(model_path)):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            relpath = os.path.relpath(path, model_path).replace(os.sep, "/")
+            if file in _MODEL_ID_FILES:
+                digest.update(relpath.encode("utf-8"))
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+            elif relpath.startswith("openvino/") and weights is not None and relpath not in weights:
+                continue
+            else:
+                digest.update(relpath.encode("utf-8"))
+                digest.update(str(os.path.getsize(path)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def sentence_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=KEY_BYTES).digest()
+
+
+class EmbeddingCache:
+    """
+    Append-only store of one model's embeddings: `vectors.f32` holds one
+    float32 row per sentence (read as a memmap), `keys.bin` the matching
+    sentence hashes. Vectors are written before keys, so an interrupted
+    append never leaves a key without its vector.
+    """
+
+    def __init__(self, folder: str, dim: int):
+        self.folder = folder
+        self.dim = dim
+        self.vectors_path = os.path.join(folder, "vectors.f32")
+        self.keys_path = os.path.join(folder, "keys.bin")
+        self._index: Dict[bytes, int] = {}
+        self._vectors: np.ndarray = None
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _load(self):
+        keys = b""
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "rb") as f:
+                keys = f.read()
+        n_vectors = 0
+        if os.path.exists(self.vectors_path):
+            n_vectors = os.path.getsize(self.vectors_path) // (4 * self.dim)
+        n = min(len(keys) // KEY_BYTES, n_vectors)
+        self._index = {keys[i * KEY_BYTES : (i + 1) * KEY_BYTES]: i for i in range(n)}
+        self._map(n)
+
+    def _map(self, n: int):
+        # (re)map the first n rows; cheap, nothing is read until rows are used
+        self._vectors = None
+        if n:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(n, self.dim)
+            )
+
+    def _append(self, keys: List[bytes], vectors: np.ndarray):
+        # drop a torn tail from an interrupted append first
+        n = len(self._index)
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(n * 4 * self.dim)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self.keys_path, "ab") as f:
+            f.truncate(n * KEY_BYTES)
+            f.write(b"".join(keys))
+        # only the new keys are indexed, so an append costs O(len(keys))
+        for i, key in enumerate(keys):
+            self._index[key] = n + i
+        self._map(n + len(keys))
+
+    def encode(
+        self,
+        texts: List[str],
+        encode: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Embeddings of `texts`, in order. Only sentences not cached yet are
+        passed to `encode` (each once), and are cached afterwards.
+        """
+        keys = [sentence_key(t) for t in texts]
+        with self._lock:
+            missing: Dict[bytes, str] = {}
+            for key, text in zip(keys, texts):
+                if key not in self._index:
+                    missing[key] = text
+            print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} to encode")
+            if missing:
+                vectors = np.asarray(encode(list(missing.values())), dtype=np.float32)
+                self._append(list(missing), vectors)
+            rows = np.fromiter((self._index[k] for k in keys), dtype=np.int64, count=len(keys))
+            return np.array(self._vectors[rows]) if len(rows) else np.empty((0, self.dim), np.float32)
+
+
+_embedding_caches: Dict[str, EmbeddingCache] = {}
+_embedding_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_path: str, dim: int, precision: str = None) -> EmbeddingCache:
+    # EMBEDDING_CACHE_PATH="" disables the cache
+    path = os.environ.get("EMBEDDING_CACHE_PATH", EMBEDDING_CACHE_PATH)
+    if not path:
+        return None
+    folder = os.path.join(path, f"{model_id(model_path, precision)}-{dim}")
+    with _embedding_caches_lock:
+        if folder not in _embedding_caches:
+            _embedding_caches[folder] = EmbeddingCache(folder, dim)
+        return _embedding_caches[folder]
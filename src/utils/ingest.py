@@ -0,0 +1,66 @@
+# ------------------------------------------------------------------------------
+# File: ingest.py
+# Description: helpers for KriRAG's streaming ingestion (files -> sentences ->
+#              chunks -> embeddings -> Chroma): fixed-size chunking and
+#              per-stage throughput.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+CHUNK_SIZE = 512  # sentences held in memory at once while ingesting
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StageTimer:
+    """Items processed and seconds spent per pipeline stage."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.items: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str, n_items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.items[name] = self.items.get(name, 0) + n_items
+
+    def iterate(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        # times the producer, e.g. reading and splitting files
+        items = iter(items)
+        while True:
+            with self.stage(name, 0):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            self.items[name] += 1
+            yield item
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "items": self.items[name],
+                "seconds": round(seconds, 3),
+                "items_per_s": round(self.items[name] / seconds, 1) if seconds > 0 else None,
+            }
+            for name, seconds in self.seconds.items()
+        }
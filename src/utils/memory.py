@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------------
+# File: memory.py
+# Description: query memory for KriRAG, i.e. the findings carried from one
+#              batch to the next, and the policies for compacting it.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from utils.batch import approx_token_count
+
+# always: summarise with the LLM before every batch (one extra call per batch)
+# every_n: summarise once `every_n` new findings have been collected
+# tokens: summarise once the memory exceeds `max_tokens`
+# truncate: never call the LLM, keep the most recent sentences that fit
+MEMORY_POLICIES = ("always", "every_n", "tokens", "truncate")
+
+_sentence_end = re.compile(r"(?<=[.!?])\s+")
+
+
+class QueryMemory:
+    """
+    Findings collected for a single query, compacted according to `policy`.
+
+    `compact(entries, doc_id) -> str` summarises the memory (an LLM call).
+    With `background=True` the compaction runs in a worker thread, and the
+    next batch is analysed with the last compacted memory plus the newest
+    findings (truncated to `max_tokens`) instead of waiting for it.
+    """
+
+    def __init__(
+        self,
+        compact: Callable[[List[str], str], str] = None,
+        policy: str = "always",
+        every_n: int = 3,
+        max_tokens: int = 1000,
+        count_tokens: Callable[[str], int] = approx_token_count,
+        background: bool = False,
+    ):
+        if policy not in MEMORY_POLICIES:
+            raise ValueError(f"Unknown memory policy {policy}, choose from {MEMORY_POLICIES}")
+        if policy != "truncate" and compact is None:
+            raise ValueError(f"Memory policy {policy} needs a compact function")
+        self.compact = compact
+        self.policy = policy
+        self.every_n = every_n
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.background = background
+
+        self.compacted: str = ""
+        self.pending: List[str] = []
+        self.compactions: int = 0  # llm calls made
+        self.would_compact: int = 0  # llm calls the "always" policy would make
+        self._job: Future = None
+        self._job_size: int = 0
+        self._executor: ThreadPoolExecutor = None
+
+    @property
+    def entries(self) -> List[str]:
+        return [self.compacted] + self.pending
+
+    def add(self, summary: str):
+        if summary:
+            self.pending.append(summary)
+
+    def context(self, doc_id: str = "") -> str:
+        # the memory to hand to the next ask_llm call
+        self._collect()
+        if self.pending:
+            self.would_compact += 1
+        if self.pending and self._job is None and self._should_compact():
+            if self.background:
+                self._start_compaction(doc_id)
+            else:
+                self._compact_now(doc_id)
+        return self._truncate(" ".join(e for e in self.entries if e))
+
+    def close(self):
+        if self._job is not None:
+            self._job.result()
+            self._collect()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy,
+            "llm_calls": self.compactions,
+            "llm_calls_saved": self.would_compact - self.compactions,
+        }
+
+    def _should_compact(self) -> bool:
+        if self.policy == "always":
+            return True
+        if self.policy == "every_n":
+            return len(self.pending) >= self.every_n
+        if self.policy == "tokens":
+            memory = " ".join(e for e in self.entries if e)
+            return self.count_tokens(memory) > self.max_tokens
+        return False
+
+    def _run_compaction(self, entries: List[str], doc_id: str) -> str:
+        try:
+            return self.compact(entries, doc_id)
+        except Exception as e:
+            # losing old findings beats stalling the analysis
+            print(f"Memory compaction failed ({e!r}). Truncating instead")
+            return self._truncate(" ".join(e for e in entries if e))
+
+    def _compact_now(self, doc_id: str):
+        self.compactions += 1
+        self.compacted = self._run_compaction(self.entries, doc_id)
+        self.pending = []
+
+    def _start_compaction(self, doc_id: str):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self.compactions += 1
+        self._job_size = len(self.pending)
+        self._job = self._executor.submit(self._run_compaction, self.entries, doc_id)
+
+    def _collect(self):
+        # fold in a finished background compaction
+        if self._job is None or not self._job.done():
+            return
+        self.compacted = self._job.result()
+        self.pending = self.pending[self._job_size :]
+        self._job = None
+
+    def _truncate(self, text: str) -> str:
+        # keep the most recent sentences that fit in max_tokens
+        if not text or self.count_tokens(text) <= self.max_tokens:
+            return text
+        kept: List[str] = []
+        total = 0
+        for sentence in reversed(_sentence_end.split(text)):
+            total += self.count_tokens(sentence)
+            if total > self.max_tokens:
+                break
+            kept.append(sentence)
+        return " ".join(reversed(kept))
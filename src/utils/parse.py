@@ -0,0 +1,212 @@
+# ------------------------------------------------------------------------------
+# File: parse.py
+# Description: reading and sentence splitting of KriRAG documents (.txt,
+#              .json, .jsonl, from folders or straight from zip archives),
+#              serially or spread over a process pool. Kept free of heavy
+#              imports (streamlit, models) so pool workers start quickly.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import io
+import json
+import multiprocessing
+import os
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Any, Dict, Iterable, Iterator, List, Tuple
+
+import nltk
+
+LANG = "english"
+VALID_EXTS = (".txt", ".json", ".jsonl")
+PARAGRAPHS_PER_TASK = 2000  # very large files are split across workers
+PARALLEL_MIN_BYTES = 5 * 1024 * 1024  # smaller uploads are parsed in-process
+
+
+def sentencize_paragraphs(
+    docs: List[str], lang: str = LANG, strip_newlines: bool = True
+) -> List[List[str]]:
+    # the sentences of each paragraph
+    if strip_newlines:
+        docs = [d.replace("\n", "") for d in docs]
+    return [nltk.sent_tokenize(paragraph, language=lang) for paragraph in docs]
+
+
+def build_records(
+    paragraphs: List[List[str]], document_name: str = ""
+) -> List[Dict[str, Any]]:
+    # page_id: paragraph index, sent_id: sentence index within the document
+    parsed_data = []
+    for d_id, sentences in enumerate(paragraphs):
+        for sent in sentences:
+            parsed_data.append(
+                {
+                    "id": document_name,
+                    "page_id": d_id,
+                    "sent_id": len(parsed_data),
+                    "text": sent,
+                }
+            )
+    return parsed_data
+
+
+def parse_document(
+    docs: List[str],
+    lang: str = LANG,
+    strip_newlines: bool = True,
+    document_name: str = "",
+) -> List[Dict[str, Any]]:
+    if strip_newlines:
+        print(f"Stripping newlines from {len(docs)} documents.")
+    return build_records(sentencize_paragraphs(docs, lang, strip_newlines), document_name)
+
+
+def _json_documents(obj: Any, name: str) -> Iterator[Tuple[str, List[str]]]:
+    # a string, a list of paragraphs, an object with "text" (and "id"), or a list of those
+    if isinstance(obj, str):
+        yield name, obj.splitlines()
+    elif isinstance(obj, dict):
+        text = obj.get("text", "")
+        paragraphs = text.splitlines() if isinstance(text, str) else [str(t) for t in text]
+        yield str(obj.get("id", name)), paragraphs
+    elif isinstance(obj, list):
+        if all(isinstance(o, str) for o in obj):
+            yield name, obj
+        else:
+            for i, o in enumerate(obj):
+                yield from _json_documents(o, f"{name}-{i}")
+
+
+def read_documents(filename: str, stream: IO[bytes]) -> Iterator[Tuple[str, List[str]]]:
+    # (document name, paragraphs) of a .txt, .json or .jsonl file, decoded as it is read
+    name, ext = os.path.splitext(os.path.basename(filename))
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    ext = ext.lower()
+    if ext == ".txt":
+        yield name, list(text)
+    elif ext == ".jsonl":
+        for i, line in enumerate(text):
+            if line.strip():
+                yield from _json_documents(json.loads(line), f"{name}-{i}")
+    elif ext == ".json":
+        yield from _json_documents(json.load(text), name)
+
+
+def _is_document(filename: str) -> bool:
+    base = os.path.basename(filename)
+    return (
+        os.path.splitext(base)[1].lower() in VALID_EXTS
+        and not base.startswith(".")
+        and "__MACOSX" not in filename
+    )
+
+
+def list_document_files(folder_path: str) -> List[str]:
+    # in a stable order, so document and id order do not depend on the filesystem
+    paths = []
+    for root, _, files in sorted(os.walk(folder_path)):
+        for file in sorted(files):
+            if _is_document(file):
+                paths.append(os.path.join(root, file))
+    return paths
+
+
+def iter_folder_documents(paths: List[str]) -> Iterator[Tuple[str, List[str]]]:
+    for path in paths:
+        with open(path, "rb") as f:
+            yield from read_documents(path, f)
+
+
+def zip_members(zip_file: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    return sorted(
+        (i for i in zip_file.infolist() if not i.is_dir() and _is_document(i.filename)),
+        key=lambda i: i.filename,
+    )
+
+
+def iter_zip_documents(zip_file: zipfile.ZipFile) -> Iterator[Tuple[str, List[str]]]:
+    # members are decompressed as a stream, never extracted to disk
+    for info in zip_members(zip_file):
+        with zip_file.open(info) as f:
+            yield from read_documents(info.filename, f)
+
+
+def parse_workers(total_bytes: int, workers: int) -> int:
+    # a process pool only pays off for large uploads
+    return workers if total_bytes >= PARALLEL_MIN_BYTES else 1
+
+
+def _init_worker(nltk_paths: List[str], lang: str):
+    # preload punkt once per worker instead of once per task
+    nltk.data.path[:] = nltk_paths
+    nltk.sent_tokenize("Warm up.", language=lang)
+
+
+_pool: ProcessPoolExecutor = None
+_pool_workers: int = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers: int, lang: str) -> ProcessPoolExecutor:
+    # one pool per process, reused across uploads and passes over the files
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                # spawn: never fork a process holding threads and a loaded model
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(list(nltk.data.path), lang),
+            )
+            _pool_workers = workers
+        return _pool
+
+
+def iter_documents(
+    documents: Iterable[Tuple[str, List[str]]], lang: str = LANG, workers: int = 1
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    (document name, sentence records) per (document name, paragraphs), in
+    order. With workers > 1, paragraph chunks are split in a process pool;
+    ids are assigned here, so they match the serial parse.
+    """
+    if workers <= 1:
+        for name, lines in documents:
+            yield name, parse_document(lines, lang, document_name=name)
+        return
+
+    pool = _get_pool(workers, lang)
+
+    def tasks():
+        for name, lines in documents:
+            n_chunks = max(1, -(-len(lines) // PARAGRAPHS_PER_TASK))
+            for i in range(n_chunks):
+                chunk = lines[i * PARAGRAPHS_PER_TASK : (i + 1) * PARAGRAPHS_PER_TASK]
+                yield name, i == n_chunks - 1, chunk
+
+    # a bounded window of tasks in flight keeps memory flat and output ordered
+    pending = deque()
+    paragraphs: List[List[str]] = []
+    task_iter = tasks()
+    while True:
+        task = next(task_iter, None)
+        if task is not None:
+            name, last, chunk = task
+            pending.append((name, last, pool.submit(sentencize_paragraphs, chunk, lang)))
+        while pending and (
+            task is None or len(pending) > 2 * workers or pending[0][2].done()
+        ):
+            name, last, future = pending.popleft()
+            paragraphs.extend(future.result())
+            if last:
+                yield name, build_records(paragraphs, name)
+                paragraphs = []
+        if task is None:
+            return
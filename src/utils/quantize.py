@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------------------
+# File: quantize.py
+# Description: compact embedding storage for KriRAG: float16, or int8 with a
+#              per-vector scale, searched approximately and re-scored in full
+#              precision.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+from typing import Tuple
+
+import numpy as np
+
+STORAGE_DTYPES = ("float32", "float16", "int8")
+RESCORE_OVERSAMPLE = 4  # approximate candidates re-scored per requested result
+SEARCH_BLOCK = 65_536  # rows dequantized at a time while scanning
+
+
+def quantize(vectors: np.ndarray, dtype: str = "int8") -> Tuple[np.ndarray, np.ndarray]:
+    # codes and per-vector scales (all ones unless int8)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype {dtype}, choose from {STORAGE_DTYPES}")
+    scales = np.ones(len(vectors), dtype=np.float32)
+    if dtype == "float32":
+        return vectors, scales
+    if dtype == "float16":
+        return vectors.astype(np.float16), scales
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+class QuantizedVectors:
+    """
+    Inner-product search over quantized rows. `search` scans the compact
+    codes for `k * oversample` candidates, then re-scores them with the
+    full-precision vectors when given (e.g. a float32 memmap on disk).
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_float(cls, vectors: np.ndarray, dtype: str = "int8") -> "QuantizedVectors":
+        return cls(*quantize(vectors, dtype))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def dtype(self) -> str:
+        return self.codes.dtype.name
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.dtype == "int8" else 0)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        # (n_queries, n_rows) approximate inner products
+        queries = np.asarray(queries, dtype=np.float32)
+        out = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_BLOCK):
+            block = slice(start, start + SEARCH_BLOCK)
+            rows = self.codes[block]
+            if rows.dtype != np.float32:
+                rows = rows.astype(np.float32)
+            out[:, block] = queries @ rows.T
+            if self.dtype == "int8":
+                # the scale is per row, so it applies after the product
+                out[:, block] *= self.scales[block]
+        return out
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        full: np.ndarray = None,
+        oversample: int = RESCORE_OVERSAMPLE,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # (indices, scores) of the k best rows per query, best first
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+        if k <= 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        scores = self.scores(queries)
+        rescore = full is not None and self.dtype != "float32"
+        n_candidates = min(k * oversample, len(self)) if rescore else k
+        candidates = _top_k(scores, n_candidates)
+        if rescore:
+            # exact scores for the shortlist only
+            scores = np.stack(
+                [np.asarray(full[c], dtype=np.float32) @ q for q, c in zip(queries, candidates)]
+            )
+        else:
+            scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(candidates, order, axis=1),
+            np.take_along_axis(scores, order, axis=1),
+        )
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    # unsorted indices of the k largest scores per row
+    if k >= scores.shape[1]:
+        return np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
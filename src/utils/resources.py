@@ -0,0 +1,73 @@
+# ------------------------------------------------------------------------------
+# File: resources.py
+# Description: process-wide registry of the heavy resources of KriRAG (the
+#              embedding model, the Chroma client, punkt), loaded lazily on
+#              first use and shared by all sessions and reruns.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import logging
+import threading
+from typing import Iterable
+
+import chromadb
+import nltk
+import streamlit as st
+from chromadb.config import Settings
+
+from utils.catalog import CHROMA_PATH
+from utils.embeddings import OPENVINO_FILES
+
+
+@st.cache_resource(show_spinner="Loading SentenceTransformer model...")
+def get_embedding_model(model_path: str, precision: str = "fp32"):
+    # imported here, so pages render before torch/openvino are loaded
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(
+        model_path,
+        backend="openvino",  # we optimize cpu-inference to reduce docker container image (w/ cuda drivers etc.)
+        model_kwargs={"file_name": OPENVINO_FILES[precision]},
+        local_files_only=True,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_chroma_client(path: str = CHROMA_PATH) -> chromadb.ClientAPI:
+    return chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+
+
+@st.cache_resource(show_spinner=False)
+def load_punkt(lang: str) -> bool:
+    # nltk keeps loaded punkt models for the process; this loads one up front
+    nltk.sent_tokenize("Warm up.", language=lang)
+    return True
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_thread: threading.Thread = None
+
+
+def _warm_up(model_path: str, precision: str, langs: Iterable[str]):
+    try:
+        get_embedding_model(model_path, precision).encode(["Warm up."])
+        get_chroma_client()
+        for lang in langs:
+            load_punkt(lang)
+        logging.info("Resources warmed up")
+    except Exception as e:
+        logging.error(f"Warm-up failed: {e}")
+
+
+def warm_up(model_path: str, precision: str = "fp32", langs: Iterable[str] = ("english",)):
+    # load everything in the background, once per process
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(
+                target=_warm_up, args=(model_path, precision, list(langs)), daemon=True
+            )
+            _warm_up_thread.start()
+    return _warm_up_thread
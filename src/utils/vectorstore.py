@@ -0,0 +1,439 @@
+# ------------------------------------------------------------------------------
+# File: vectorstore.py
+# Description: vector store interface for KriRAG, with a Chroma backend and a
+#              dependency-light local backend: memory-mapped .npy columns for
+#              vectors and metadata, an optional HNSW graph (hnswlib, if
+#              installed) and optional float16/int8 scanning.
+#
+# License: Apache License 2.0
+# For license details, refer to the LICENSE file in the project root.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from utils.catalog import CHROMA_PATH
+from utils.ingest import chunked
+from utils.quantize import STORAGE_DTYPES, QuantizedVectors, dequantize, quantize
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+LOCAL_STORE_FOLDER = os.path.join(CHROMA_PATH, "local")
+VECTOR_BACKENDS = ("chroma", "local")
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128
+
+
+class VectorStore(ABC):
+    """
+    Sentences with their embeddings and metadata (document/sent_id/page_id).
+    Results use Chroma's layout: `query` returns {"ids", "documents",
+    "metadatas", "distances"} with one list per query text, `get_by_document`
+    flat lists of "ids", "documents" and "metadatas".
+    """
+
+    name: str
+
+    @abstractmethod
+    def add(
+        self,
+        ids: List[str],
+        embeddings: np.ndarray,
+        metadatas: List[Dict[str, Any]],
+        documents: List[str],
+    ):
+        pass
+
+    @abstractmethod
+    def query(self, texts: List[str], n_results: int) -> Dict[str, List[List[Any]]]:
+        pass
+
+    @abstractmethod
+    def get_by_document(self, documents: List[str] = None) -> Dict[str, List[Any]]:
+        # documents=None: every sentence in the store
+        pass
+
+    @abstractmethod
+    def delete(self, documents: List[str]):
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    def flush(self):
+        # persist pending changes, e.g. once at the end of an ingestion
+        pass
+
+
+class ChromaStore(VectorStore):
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+
+    def add(self, ids, embeddings, metadatas, documents):
+        self.collection.add(
+            ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+        )
+
+    def query(self, texts, n_results):
+        return self.collection.query(
+            query_texts=texts,
+            n_results=n_results,
+            include=["documents", "metadatas", "distances"],
+        )
+
+    def get_by_document(self, documents=None):
+        where = None if documents is None else {"document": {"$in": list(documents)}}
+        return self.collection.get(where=where, include=["documents", "metadatas"])
+
+    def delete(self, documents):
+        self.collection.delete(where={"document": {"$in": list(documents)}})
+
+    def count(self):
+        return self.collection.count()
+
+
+class _Column:
+    """Memory-mapped .npy column with spare rows, grown by doubling."""
+
+    def __init__(self, path: str, dtype, tail: tuple = ()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.tail = tuple(tail)
+        self.array: np.ndarray = None
+        if os.path.exists(path):
+            self.array = np.load(path, mmap_mode="r+")
+
+    def capacity(self) -> int:
+        return 0 if self.array is None else len(self.array)
+
+    def write(self, start: int, values: np.ndarray):
+        end = start + len(values)
+        if end > self.capacity():
+            self._grow(end)
+        self.array[start:end] = values
+
+    def _grow(self, size: int):
+        capacity = max(size, 2 * self.capacity(), 1024)
+        grown = np.lib.format.open_memmap(
+            f"{self.path}.tmp", mode="w+", dtype=self.dtype, shape=(capacity,) + self.tail
+        )
+        if self.array is not None:
+            grown[: len(self.array)] = self.array
+        grown.flush()
+        os.replace(f"{self.path}.tmp", self.path)
+        self.array = grown
+
+    def flush(self):
+        if self.array is not None:
+            self.array.flush()
+
+
+class _Strings:
+    """Append-only utf-8 strings: a blob plus a column of end offsets."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ends = _Column(f"{path}.ends.npy", np.int64)
+
+    def append(self, start: int, values: List[str]):
+        offset = int(self.ends.array[start - 1]) if start else 0
+        encoded = [v.encode("utf-8") for v in values]
+        with open(self.path, "ab") as f:
+            f.truncate(offset)  # drop a torn tail from an interrupted append
+            f.write(b"".join(encoded))
+        self.ends.write(start, offset + np.cumsum([len(e) for e in encoded]))
+
+    def read(self, rows: np.ndarray) -> List[str]:
+        rows = np.asarray(rows, dtype=np.int64)
+        ends = self.ends.array[rows].tolist()
+        starts = np.where(rows > 0, self.ends.array[np.maximum(rows - 1, 0)], 0).tolist()
+        values = []
+        with open(self.path, "rb") as f:
+            for start, end in zip(starts, ends):
+                f.seek(start)
+                values.append(f.read(end - start).decode("utf-8"))
+        return values
+
+
+class LocalStore(VectorStore):
+    """
+    Flat store in a folder of memory-mapped .npy columns. Rows are appended;
+    deletes mark rows dead and the store is compacted once most are dead.
+    Changes are persisted by `flush`, which writes `meta.json` last, so rows
+    added since the last flush are ignored on open.
+    Vectors are normalized and searched by cosine distance, by scanning
+    (float32, or float16/int8 codes) or with an HNSW graph when `hnsw=True`
+    and hnswlib is installed. float16/int8 stores keep only the codes (2x/4x
+    smaller), unless `rescore=True` also keeps float32 vectors to re-score
+    the best candidates with.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        embed: Callable[[List[str]], Any],
+        dtype: str = "float32",
+        hnsw: bool = False,
+        rescore: bool = False,
+    ):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype {dtype}, choose from {STORAGE_DTYPES}")
+        if hnsw and hnswlib is None:
+            logging.warning("hnswlib is not installed, searching the local store exhaustively")
+        self.folder = folder
+        self.name = os.path.basename(folder)
+        self.embed = embed
+        self.use_hnsw = hnsw and hnswlib is not None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._open(dtype, rescore)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def _open(self, dtype: str, rescore: bool):
+        # only small files are read; the columns are memory-mapped
+        os.makedirs(self.folder, exist_ok=True)
+        meta = {"dim": None, "rows": 0, "dtype": dtype, "rescore": rescore, "documents": []}
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        self.dim: int = meta["dim"]
+        self.rows: int = meta["rows"]
+        self.dtype: str = meta["dtype"]  # fixed when the store was created
+        self.rescore: bool = meta.get("rescore", True) or self.dtype == "float32"
+        self.documents: List[str] = meta["documents"]
+        self._document_index = {d: i for i, d in enumerate(self.documents)}
+
+        self.doc = _Column(self._path("doc.npy"), np.int32)
+        self.sent_id = _Column(self._path("sent_id.npy"), np.int32)
+        self.page_id = _Column(self._path("page_id.npy"), np.int32)
+        self.alive = _Column(self._path("alive.npy"), np.bool_)
+        self.ids = _Strings(self._path("ids.bin"))
+        self.texts = _Strings(self._path("texts.bin"))
+        self.vectors = self.codes = self.scales = None
+        self._hnsw = None
+        self.n_dead = self.rows - int(self.alive.array[: self.rows].sum()) if self.rows else 0
+        if self.dim is not None:
+            self._open_vectors()
+
+    def _open_vectors(self):
+        if self.rescore:
+            self.vectors = _Column(self._path("vectors.npy"), np.float32, (self.dim,))
+        if self.dtype != "float32":
+            self.codes = _Column(self._path("codes.npy"), self.dtype, (self.dim,))
+            self.scales = _Column(self._path("scales.npy"), np.float32)
+        if self.use_hnsw:
+            self._open_hnsw()
+
+    def _open_hnsw(self):
+        index = hnswlib.Index(space="cosine", dim=self.dim)
+        if os.path.exists(self._path("hnsw.bin")):
+            index.load_index(self._path("hnsw.bin"), max_elements=max(self.rows, 1))
+        else:
+            index.init_index(
+                max_elements=max(self.rows, 1024), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M
+            )
+            if self.rows:
+                index.add_items(self._float_rows(np.arange(self.rows)), np.arange(self.rows))
+                for row in np.flatnonzero(~self.alive.array[: self.rows]):
+                    index.mark_deleted(int(row))
+        index.set_ef(HNSW_EF_SEARCH)
+        self._hnsw = index
+
+    def _float_rows(self, rows: np.ndarray) -> np.ndarray:
+        # float32 vectors of rows, decoded from the codes if not kept
+        if self.vectors is not None:
+            return np.asarray(self.vectors.array[rows])
+        return dequantize(self.codes.array[rows], self.scales.array[rows])
+
+    def _save_meta(self):
+        columns = (
+            self.doc,
+            self.sent_id,
+            self.page_id,
+            self.alive,
+            self.vectors,
+            self.codes,
+            self.scales,
+            self.ids.ends,
+            self.texts.ends,
+        )
+        for column in columns:
+            if column is not None:
+                column.flush()
+        if self._hnsw is not None:
+            self._hnsw.save_index(self._path("hnsw.bin"))
+        meta_path = self._path("meta.json")
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "rows": self.rows,
+                    "dtype": self.dtype,
+                    "rescore": self.rescore,
+                    "documents": self.documents,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def add(self, ids, embeddings, metadatas, documents):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if not len(vectors):
+            return
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._open_vectors()
+            start = self.rows
+            doc = [
+                self._document_index.setdefault(m["document"], len(self._document_index))
+                for m in metadatas
+            ]
+            self.documents = list(self._document_index)
+            self.doc.write(start, np.array(doc, dtype=np.int32))
+            self.sent_id.write(start, np.array([m["sent_id"] for m in metadatas], dtype=np.int32))
+            self.page_id.write(start, np.array([m["page_id"] for m in metadatas], dtype=np.int32))
+            self.alive.write(start, np.ones(len(vectors), dtype=np.bool_))
+            if self.vectors is not None:
+                self.vectors.write(start, vectors)
+            if self.codes is not None:
+                codes, scales = quantize(vectors, self.dtype)
+                self.codes.write(start, codes)
+                self.scales.write(start, scales)
+            self.ids.append(start, list(ids))
+            self.texts.append(start, list(documents))
+            if self._hnsw is not None:
+                if start + len(vectors) > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(max(start + len(vectors), 2 * self._hnsw.get_max_elements()))
+                self._hnsw.add_items(vectors, np.arange(start, start + len(vectors)))
+            self.rows = start + len(vectors)
+            self._dirty = True
+
+    def _live_rows(self, documents: List[str] = None) -> np.ndarray:
+        alive = self.alive.array[: self.rows] if self.rows else np.zeros(0, dtype=np.bool_)
+        if documents is not None:
+            wanted = [self._document_index[d] for d in documents if d in self._document_index]
+            alive = alive & np.isin(self.doc.array[: self.rows], wanted)
+        return np.flatnonzero(alive)
+
+    def _rows_result(self, rows: np.ndarray) -> Dict[str, List[Any]]:
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = zip(
+            self.doc.array[rows].tolist(),
+            self.sent_id.array[rows].tolist(),
+            self.page_id.array[rows].tolist(),
+        )
+        return {
+            "ids": self.ids.read(rows),
+            "documents": self.texts.read(rows),
+            "metadatas": [
+                {"document": self.documents[d], "sent_id": s, "page_id": p}
+                for d, s, p in columns
+            ],
+        }
+
+    def query(self, texts, n_results):
+        queries = np.asarray(self.embed(list(texts)), dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        n_results = min(n_results, self.count())
+        if n_results <= 0:
+            for key in result:
+                result[key] = [[] for _ in texts]
+            return result
+
+        if self._hnsw is not None:
+            labels, distances = self._hnsw.knn_query(queries, k=n_results)
+        else:
+            # dead rows are skipped after the search, so ask for enough extra
+            k = min(n_results + self.n_dead, self.rows)
+            if self.codes is not None:
+                index = QuantizedVectors(self.codes.array[: self.rows], self.scales.array[: self.rows])
+            else:
+                index = QuantizedVectors(
+                    self.vectors.array[: self.rows], np.ones(self.rows, dtype=np.float32)
+                )
+            # codes are re-scored with the float32 vectors, when kept
+            full = self.vectors.array if self.codes is not None and self.vectors is not None else None
+            labels, scores = index.search(queries, k, full=full)
+            distances = 1 - scores
+
+        for row_labels, row_distances in zip(labels, distances):
+            row_labels = np.asarray(row_labels, dtype=np.int64)
+            keep = np.flatnonzero(self.alive.array[row_labels])[:n_results]
+            rows_result = self._rows_result(row_labels[keep])
+            for key in ("ids", "documents", "metadatas"):
+                result[key].append(rows_result[key])
+            result["distances"].append(np.asarray(row_distances)[keep].tolist())
+        return result
+
+    def get_by_document(self, documents=None):
+        return self._rows_result(self._live_rows(documents))
+
+    def delete(self, documents):
+        with self._lock:
+            rows = self._live_rows(documents)
+            if not len(rows):
+                return
+            self.alive.array[rows] = False
+            if self._hnsw is not None:
+                for row in rows:
+                    self._hnsw.mark_deleted(int(row))
+            self.n_dead += len(rows)
+            self._dirty = True
+        if self.n_dead > self.rows // 2:
+            self.compact()
+
+    def count(self):
+        return self.rows - self.n_dead
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save_meta()
+                self._dirty = False
+
+    def compact(self, chunk_size: int = 4096):
+        # rewrite the live rows into a fresh folder and swap it in
+        with self._lock:
+            tmp = f"{self.folder}.compact"
+            shutil.rmtree(tmp, ignore_errors=True)
+            fresh = LocalStore(tmp, self.embed, self.dtype, self.use_hnsw, self.rescore)
+            for rows in chunked(self._live_rows(), chunk_size):
+                rows = np.asarray(rows)
+                result = self._rows_result(rows)
+                fresh.add(result["ids"], self._float_rows(rows), result["metadatas"], result["documents"])
+            fresh.flush()
+            del fresh
+            old = f"{self.folder}.old"
+            os.replace(self.folder, old)
+            os.replace(tmp, self.folder)
+            shutil.rmtree(old, ignore_errors=True)
+            self._open(self.dtype, self.rescore)
+            self._dirty = False
+
+
+def local_store_path(collection_name: str) -> str:
+    return os.path.join(LOCAL_STORE_FOLDER, collection_name)
+
+
+def delete_local_store(collection_name: str):
+    shutil.rmtree(local_store_path(collection_name), ignore_errors=True)